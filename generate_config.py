@@ -8,7 +8,7 @@ template_str = """\
 file=./supervisor.sock
 
 [supervisord]
-environment=RPCHOST="127.0.0.1:2474",MINIO_ROOT_USER={MINIO_ROOT_USER},MINIO_ROOT_PASSWORD={MINIO_ROOT_PASSWORD},\
+environment=RPCHOST={RPCHOST},MINIO_ROOT_USER={MINIO_ROOT_USER},MINIO_ROOT_PASSWORD={MINIO_ROOT_PASSWORD},\
 MINIO_URL={MINIO_URL},MINIO_ACCESS={MINIO_ROOT_USER},MINIO_SECRET={MINIO_ROOT_PASSWORD},\
 DATABASE={DATABASE},WEBVCC_DISABLE_STATIC="",VCC_CALL_VERBOSE="true"
 directory=%(here)s
@@ -114,6 +114,7 @@ def input_with_default(prompt: str, default: str):
     return text if text else default
 
 config_str = template_str.format_map({
+    "RPCHOST": json.dumps(input_with_default("The address of the rpc server, host:port or unix:path", "unix:./rpc.sock")),
     "MINIO_ROOT_USER": json.dumps(input_with_default("The root user name of the minio", "root")),
     "MINIO_ROOT_PASSWORD": json.dumps(input_with_default("The root password of the minio", str(uuid.uuid4()).replace("-", ""))),
     "MINIO_URL": json.dumps(input("The url that can be accessed by users: ")),
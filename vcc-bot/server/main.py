@@ -1,7 +1,6 @@
-from vcc import RpcExchanger, RpcRobotExchangerClient, ChatUserPermissionName, ChatPermissionName, NotAuthorizedError
+from vcc import RpcExchanger, RpcRobotExchangerClient, ChatUserPermissionName, ChatPermissionName, NotAuthorizedError, json_codec
 from typeguard import typechecked
 from typing import Any
-from uuid import uuid4
 
 import json
 import asyncio
@@ -96,19 +95,8 @@ async def recv_message_loop(client: RpcRobotExchangerClient, websocket: websocke
         async for i in client:
             if i[0] != "message":
                 continue
-            _, uid, username, msg, chat, session = i
-            await websocket.send(json.dumps({
-                "type": "message",
-                "ok": True,
-                "id": str(uuid4()),
-                "response": {
-                    "uid": uid,
-                    "username": username,
-                    "msg": msg,
-                    "chat": chat,
-                    "session": session
-                }
-            }))
+            _, message = i
+            await websocket.send(message.bot_frame)
     except asyncio.CancelledError:
         pass
 
@@ -121,12 +109,12 @@ async def handle_client(exchanger: RpcExchanger, websocket: websockets.server.We
         tasks: set[asyncio.Task[None]] = set()
 
         async def make_error(request_type: str, request_id: str | int, data: str) -> None:
-            await websocket.send(json.dumps({
+            await websocket.send(json_codec.dumps({
                 "type": request_type,
                 "ok": False,
                 "id": request_id,
                 "error": data
-            }))
+            }).decode())
 
         async def task(request: Any) -> None:
             request_type = request["type"]
@@ -140,12 +128,12 @@ async def handle_client(exchanger: RpcExchanger, websocket: websockets.server.We
                 logging.debug(f"{request_type=} {request_body=} {request_id=}")
                 response = await getattr(handler, request_type)(**request_body)
                 # Response: {"type": "message", "ok": true, "id": "3a9b50b1-0355-496d-96fd-52e908ab931e", "response": null}
-                await websocket.send(json.dumps({
+                await websocket.send(json_codec.dumps({
                     "type": request_type,
                     "ok": True,
                     "id": request_id,
                     "response": response
-                }))
+                }).decode())
             except ServerError as e:
                 logging.debug(e, exc_info=True)
                 await make_error(request_type, request_id, e.args[0])
@@ -166,7 +154,7 @@ async def handle_client(exchanger: RpcExchanger, websocket: websockets.server.We
                     tasks.discard(current_task)
         try:
             async for line in websocket:
-                request = json.loads(line)
+                request = json_codec.loads(line)
                 tasks.add(asyncio.create_task(task(request)))
         except ConnectionClosed:
             pass
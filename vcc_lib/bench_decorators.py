@@ -0,0 +1,65 @@
+"""
+Overhead of @check/@rpc_request per RpcExchangerClient method call,
+the exchanger is replaced by a stub which answers immediately.
+
+    python bench_decorators.py [calls]
+"""
+import asyncio
+import sys
+import time
+
+from vcc.vcc import RpcExchangerClient
+
+
+class StubExchanger:
+    async def rpc_request(self, namespace, service, arguments):
+        return arguments
+
+
+def make_client() -> RpcExchangerClient:
+    client = object.__new__(RpcExchangerClient)
+    client._exchanger = StubExchanger()  # type: ignore
+    client._id = 1
+    client._name = "bench"
+    client._chat_list = {1}
+    client._chat_list_inited = True
+    return client
+
+
+async def bench(name: str, call, calls: int):
+    start = time.perf_counter()
+    for _ in range(calls):
+        await call()
+    elapsed = time.perf_counter() - start
+    print(f"{name:<40} {elapsed / calls * 1e6:8.2f} us/call")
+
+
+async def main(calls: int):
+    client = make_client()
+    await bench("get_friends()", client.get_friends, calls)
+    await bench("is_online([1, 2])", lambda: client.is_online([1, 2]), calls)
+    await bench(
+        "chat_get_nickname(1, 1)", lambda: client.chat_get_nickname(1, 1), calls
+    )
+    await bench(
+        "chat_rename(chat_id=1, new_name=...)",
+        lambda: client.chat_rename(chat_id=1, new_name="a"),
+        calls,
+    )
+    await bench(
+        "chat_rename(2, ...), not joined",
+        lambda: client.chat_rename(2, "a"),
+        calls // 10,
+    )
+    await bench(
+        "baseline: StubExchanger.rpc_request",
+        lambda: client._exchanger.rpc_request("chat", "get_nickname", {}),
+        calls,
+    )
+
+
+if __name__ == "__main__":
+    import logging
+
+    logging.disable(logging.WARNING)
+    asyncio.run(main(int(sys.argv[1]) if len(sys.argv) > 1 else 100000))
@@ -0,0 +1,132 @@
+from __future__ import annotations
+import bisect
+import json
+import signal
+import time
+import typing
+import weakref
+
+if typing.TYPE_CHECKING:
+    from .service import RpcServiceFactory
+
+
+class Histogram:
+    """Latency histogram with fixed exponential buckets, from 0.1ms to about 52s"""
+
+    bounds = [0.0001 * 2**i for i in range(20)]
+
+    def __init__(self):
+        self.counts = [0] * (len(self.bounds) + 1)
+        self.count = 0
+        self.sum = 0.0
+
+    def observe(self, value: float):
+        self.counts[bisect.bisect_left(self.bounds, value)] += 1
+        self.count += 1
+        self.sum += value
+
+    def quantile(self, q: float) -> float | None:
+        # Upper bound of the bucket which holds the q-th observation
+        if self.count == 0:
+            return None
+        rank = q * self.count
+        seen = 0
+        for bound, count in zip(self.bounds, self.counts):
+            seen += count
+            if seen >= rank:
+                return bound
+        return float("inf")
+
+
+class MethodStats:
+    def __init__(self):
+        self.calls = 0
+        self.errors = 0
+        self.in_flight = 0
+        self.request_bytes = 0
+        self.response_bytes = 0
+        self.latency = Histogram()
+
+    def start(self, request_bytes: int = 0) -> float:
+        self.calls += 1
+        self.in_flight += 1
+        self.request_bytes += request_bytes
+        return time.perf_counter()
+
+    def finish(self, start: float, response_bytes: int = 0, error: bool = False):
+        self.in_flight -= 1
+        self.response_bytes += response_bytes
+        if error:
+            self.errors += 1
+        self.latency.observe(time.perf_counter() - start)
+
+    def snapshot(self) -> dict[str, typing.Any]:
+        return {
+            "calls": self.calls,
+            "errors": self.errors,
+            "in_flight": self.in_flight,
+            "request_bytes": self.request_bytes,
+            "response_bytes": self.response_bytes,
+            "p50": self.latency.quantile(0.5),
+            "p95": self.latency.quantile(0.95),
+            "p99": self.latency.quantile(0.99),
+        }
+
+
+class RpcMetrics:
+    """
+    Per `namespace.service` statistics of a RpcServiceFactory.
+    `caller` is filled by Transport.call, `callee` by Transport.do_request.
+    """
+
+    def __init__(self, factory: RpcServiceFactory):
+        self._factory = factory
+        self.caller: dict[str, MethodStats] = {}
+        self.callee: dict[str, MethodStats] = {}
+        _registries.add(self)
+
+    @staticmethod
+    def _get(table: dict[str, MethodStats], namespace: str, service: str) -> MethodStats:
+        key = f"{namespace}.{service}"
+        if (stats := table.get(key)) is None:
+            stats = table[key] = MethodStats()
+        return stats
+
+    def call(self, namespace: str, service: str) -> MethodStats:
+        return self._get(self.caller, namespace, service)
+
+    def request(self, namespace: str, service: str) -> MethodStats:
+        return self._get(self.callee, namespace, service)
+
+    def snapshot(self) -> dict[str, typing.Any]:
+        return {
+            "jobs": sum(len(i.jobs) for i in self._factory.connections),
+            "caller": {key: value.snapshot() for key, value in self.caller.items()},
+            "callee": {key: value.snapshot() for key, value in self.callee.items()},
+            "pools": {
+                name: {key: value.snapshot() for key, value in pools.items()}
+                for name, pools in self._factory.pools.items()
+            },
+        }
+
+
+_registries: weakref.WeakSet[RpcMetrics] = weakref.WeakSet()
+_signal_installed = False
+
+
+def dump_all(*_):
+    for registry in list(_registries):
+        print("rpc stats: " + json.dumps(registry.snapshot()), flush=True)
+
+
+def install_signal_handler(loop):
+    """Dump every registry on SIGUSR1, only once per process"""
+    global _signal_installed
+    if _signal_installed or not hasattr(signal, "SIGUSR1"):
+        return
+    try:
+        loop.add_signal_handler(signal.SIGUSR1, dump_all)
+    except (NotImplementedError, RuntimeError):
+        # Not in the main thread or unsupported loop
+        return
+    _signal_installed = True
@@ -7,16 +7,29 @@ from service import ServiceExport as export
 class rpc():
     def __init__(self,factory:service.RpcServiceFactory):
         self.factory=factory
-    def register(self,namespace:list):
+    def register(self,namespace:list,address:list|None=None):
         svc=request_context.Service
+        if address is not None:
+            svc.address=tuple(address)
         if type(namespace)==str:
-            self.factory.services[namespace]=service.RemoteExport(svc,namespace)
-            return
+            namespace=[namespace]
         for i in namespace:
-            self.factory.services[i]=service.RemoteExport(svc,i)
+            # Another replica of a registered namespace joins its pool
+            if isinstance(export:=dict.get(self.factory.services,i),service.RemoteExport):
+                export.add_connection(svc)
+            else:
+                self.factory.services[i]=service.RemoteExport(svc,i)
         print(self.factory.services)
     def list_providers(self):
         return list(self.factory.services.keys())
+    def stats(self):
+        return self.factory.metrics.snapshot()
+    def lookup(self,namespace:str):
+        """Addresses the providers of a namespace accept direct connections on"""
+        export=dict.get(self.factory.services,namespace)
+        if not isinstance(export,service.RemoteExport):
+            return []
+        return [i.address for i in export.connection if i.address is not None]
 if __name__=="__main__":
     server=service.RpcServiceFactory()
     server.register(rpc(server))
@@ -1,19 +1,28 @@
 from __future__ import annotations
 import os
 import asyncio
+import collections.abc
+import concurrent.futures
+import contextvars
 import inspect
-import json
 import functools
 import typing
 import logging
 import traceback
 import enum
+import itertools
+import random
+import struct
+import threading
+import time
 import uuid
 
 try:
     from . import tools
+    from . import metrics
 except ImportError:
     import tools
+    import metrics
 # from twisted.internet import task ### No more twisted
 # from twisted.internet.defer import Deferred
 # from twisted.internet.protocol import ClientFactory
@@ -25,11 +34,64 @@ RpcServiceRole = enum.Enum("RpcServiceRole", ["SERVER", "CLIENT"])
 TransportStatus = enum.Enum("TransportStatus", ["CONNECTING", "CONNECTED","ERROR"])
 request_context=tools.ContextObject()
 
+# Big-endian length of the body, followed by the encoded body
+FRAME_HEADER = struct.Struct("!I")
+MAX_FRAME_SIZE = int(os.getenv("VCC_MAX_FRAME_SIZE", 64 << 20))
+# Body codecs which can be chosen after switching to length-prefixed frames
+codecs = tools.codecs
+
+class ServicePool:
+    """Executor of a service which knows how many jobs are waiting or running"""
+
+    def __init__(self, executor: concurrent.futures.Executor, size: int):
+        self.executor = executor
+        self.size = size
+        self.pending = 0
+        self.completed = 0
+        self._lock = threading.Lock()
+
+    def _done(self, _):
+        with self._lock:
+            self.pending -= 1
+            self.completed += 1
+
+    def submit(self, func, *args, **kwargs) -> concurrent.futures.Future:
+        with self._lock:
+            self.pending += 1
+        future = self.executor.submit(func, *args, **kwargs)
+        future.add_done_callback(self._done)
+        return future
+
+    def snapshot(self) -> dict[str, int]:
+        return {
+            "size": self.size,
+            "pending": self.pending,
+            "queued": max(self.pending - self.size, 0),
+            "completed": self.completed,
+        }
+
+
+def run_in_process(func, *args, **kwargs):
+    """
+    Run a CPU-bound function in the process pool of the service being served,
+    blocking the calling worker thread, or just call it if there is no pool.
+    func and its arguments must be picklable.
+    """
+    pool: ServicePool | None = request_context.process_pool
+    if pool is None:
+        return func(*args, **kwargs)
+    return pool.submit(func, *args, **kwargs).result()
+
+
 class ServiceExport:
-    def __init__(self, func=None, async_mode=False, thread=False, instance=None):
+    def __init__(self, func=None, async_mode=False, thread=False, instance=None, process=False):
         self.instance = instance
         self.async_mode = async_mode
         self.thread = thread
+        # Run in the process pool of the service, see RpcServiceFactory.register
+        self.process = process
+        self.executor: ServicePool | None = None
+        self.process_executor: ServicePool | None = None
         if func is None:
             self.func: typing.Callable[..., typing.Any] = typing.cast(typing.Any, None)
             return
@@ -45,8 +107,19 @@ class ServiceExport:
             return self
         if self.instance:
             args = (self.instance,) + args
+        if inspect.isasyncgenfunction(self.func):
+            # Streamed to the caller chunk by chunk, see TcpTransport.send_stream
+            future = asyncio.Future()
+            future.set_result(self.func(*args, **kwargs))
+            return future
         if self.async_mode:
             return self.func(*args, **kwargs)
+        if self.process and self.process_executor is not None:
+            return asyncio.wrap_future(self.process_executor.submit(self.func, *args, **kwargs))
+        if self.executor is not None:
+            request_context.process_pool = self.process_executor
+            context = contextvars.copy_context()
+            return asyncio.wrap_future(self.executor.submit(context.run, self.func, *args, **kwargs))
         if self.thread:
             return asyncio.get_running_loop().run_in_executor(
                 None, lambda: self.func(*args, **kwargs)
@@ -61,19 +134,46 @@ class ServiceExport:
 
 
 class RemoteExport:
+    """
+    A namespace provided by one or more remote replicas.
+    Calls go to the replica with the fewest jobs in flight ("least_in_flight")
+    or to each replica in turn ("round_robin"), see VCC_RPC_BALANCE.
+    """
+
+    balance = os.getenv("VCC_RPC_BALANCE", "least_in_flight")
+
     def __init__(self, service: Transport, namespace: str):
         self.service = service
-        print(service)
         self.namespace = namespace
-        self.connection = []
+        self.connection: list[Transport] = []
         self.alive = 0
+        self._counter = itertools.count()
         self.add_connection(service)
     def add_connection(self, connection):
+        if connection in self.connection:
+            return
         self.connection.append(connection)
         self.alive += 1
+    def remove_connection(self, connection) -> int:
+        if connection in self.connection:
+            self.connection.remove(connection)
+            self.alive -= 1
+        return self.alive
+
+    def pick(self) -> Transport:
+        if not self.connection:
+            raise RuntimeError(f"no alive provider of {self.namespace}")
+        start = next(self._counter) % len(self.connection)
+        if self.balance == "round_robin":
+            return self.connection[start]
+        # Rotate the start so that ties don't always go to the first replica
+        return min(
+            self.connection[start:] + self.connection[:start],
+            key=lambda connection: len(connection.jobs),
+        )
 
     def __getitem__(self, name):
-        return lambda **x: self.connection[0].call(self.namespace, name, x)
+        return lambda **x: self.pick().call(self.namespace, name, x)
 
 
 class SuperService:
@@ -94,46 +194,174 @@ class ServiceMeta(type):
 
 
 class lineReceiver(asyncio.Protocol):
-    line_buffer = b""
+    """
+    CRLF line protocol which can be switched to length-prefixed frames.
+
+    Reading and writing are switched separately (see ``TcpTransportProtocol``),
+    so that the handshake can be finished with lines while the rest of the
+    stream is framed.
+    """
+
+    framed_read = False
+    framed_write = False
 
     def connection_made(self, transport: asyncio.Transport) -> None:
         self.connection = transport
+        self._buffer = bytearray()
 
     def data_received(self, data: bytes) -> None:
-        datas = data.split(b"\r\n")
-        datas[0] = self.line_buffer + datas[0]
-        self.line_buffer = datas.pop()
-        for i in datas:
-            print("<<"+i.decode())
-            self.line_received(i.decode())
+        buffer = self._buffer
+        buffer += data
+        offset = 0
+        while offset < len(buffer):
+            if self.framed_read:
+                if len(buffer) - offset < FRAME_HEADER.size:
+                    break
+                (length,) = FRAME_HEADER.unpack_from(buffer, offset)
+                if length > MAX_FRAME_SIZE:
+                    log.warning(f"frame too large ({length} bytes), closing")
+                    self.connection.close()
+                    return
+                start = offset + FRAME_HEADER.size
+                if start + length > len(buffer):
+                    break
+                with memoryview(buffer) as view, view[start : start + length] as frame:
+                    self.frame_received(frame)
+                offset = start + length
+            else:
+                end = buffer.find(b"\r\n", offset)
+                if end == -1:
+                    break
+                line = bytes(buffer[offset:end])
+                if call_verbose:
+                    print("<<" + line.decode())
+                offset = end + 2
+                self.line_received(line)
+        del buffer[:offset]
 
     def sendLine(self, data):
-        print(">>"+data.decode())
+        if call_verbose:
+            print(">>" + data.decode())
         self.connection.write(data + b"\r\n")
+        return len(data) + 2
 
-    def line_received(self, data):
+    def sendFrame(self, data):
+        self.connection.writelines((FRAME_HEADER.pack(len(data)), data))
+        return FRAME_HEADER.size + len(data)
+
+    def line_received(self, data: bytes):
+        pass
+
+    def frame_received(self, data: memoryview):
         pass
 
 
+class RpcStream:
+    """
+    Async iterator over the chunks of a streamed response.
+    Call aclose() when stopping early, so that the callee stops too.
+    """
+
+    _end = object()
+
+    def __init__(self, transport: Transport, jobid: str):
+        self.transport = transport
+        self.jobid = jobid
+        self.deadline: float | None = None
+        self.queue: asyncio.Queue = asyncio.Queue()
+        self.done = False
+
+    def __aiter__(self):
+        return self
+
+    async def __anext__(self):
+        if self.done:
+            raise StopAsyncIteration
+        if not self.queue.empty() or self.deadline is None:
+            item = self.queue.get_nowait() if not self.queue.empty() else await self.queue.get()
+        else:
+            try:
+                item = await asyncio.wait_for(
+                    self.queue.get(), self.deadline - asyncio.get_running_loop().time()
+                )
+            except asyncio.TimeoutError:
+                await self.aclose()
+                raise tools.DeadlineExceededError() from None
+        if item is self._end:
+            self.done = True
+            raise StopAsyncIteration
+        if isinstance(item, BaseException):
+            self.done = True
+            raise item
+        return item
+
+    async def aclose(self):
+        if not self.done:
+            self.done = True
+            self.transport.streams.pop(self.jobid, None)
+            self.transport.send_cancel(self.jobid)
+
+
 class Transport():
-    def __init__(self, factory):
+    def __init__(self, factory, direct=False):
         self.factory: RpcServiceFactory = factory
-        self.factory.connections.append(self)
+        # Direct connections between services are kept out of factory.connections,
+        # which must only hold the connection to the router
+        self.direct = direct
+        if not direct:
+            self.factory.connections.append(self)
         self.jobs: dict[str, asyncio.Future] = {}
+        # Streamed responses still being received
+        self.streams: dict[str, RpcStream] = {}
+        # Requests of the peer being served, so that they can be cancelled
+        self.requests: dict[str, asyncio.Task] = {}
+        # Exports the peer announced in its handshake
+        self.capacity: list[str] = []
+        # Where the peer accepts direct connections, if it does
+        self.address: tuple[str, int] | None = None
 
     # def connection_lost(self, exc: Exception | None):
     #     if self.role == RpcServiceRole.CLIENT:
     #         self.factory.on_con_lost.set_result(True)
 
-    async def call(self,namespace, service, kwargs):
+    async def call(self,namespace, service, kwargs, timeout=None):
         raise NotImplementedError()
-    async def do_request(self, data):
+    async def do_request(self, data, size=0):
         raise NotImplementedError
-    def make_respond(self, jobid, data):
+    def make_respond(self, jobid, data, size=0):
         raise NotImplementedError()
+    def make_error(self, jobid, exception):
+        if (future := self.jobs.get(jobid)) is not None and not future.done():
+            future.set_exception(exception)
+    def make_chunk(self, jobid, data, size=0):
+        if (stream := self.streams.get(jobid)) is None:
+            # The first chunk answers the call itself
+            if (future := self.jobs.get(jobid)) is None or future.done():
+                return
+            stream = self.streams[jobid] = RpcStream(self, jobid)
+            future.set_result((stream, size))
+        stream.queue.put_nowait(data)
+    def end_stream(self, jobid, error=None):
+        if (stream := self.streams.pop(jobid, None)) is None:
+            if (future := self.jobs.get(jobid)) is None or future.done():
+                return
+            # Nothing was streamed
+            stream = RpcStream(self, jobid)
+            future.set_result((stream, 0))
+        stream.queue.put_nowait(RpcStream._end if error is None else tools.UnknownError(error))
+    def fail_jobs(self, exception):
+        for i in self.jobs.values():
+            if not i.done():
+                i.set_exception(exception)
+        for i in self.streams.values():
+            i.queue.put_nowait(exception)
+        self.streams.clear()
     @classmethod
     async def alisten(cls,factory,host):
         raise NotImplementedError()
+    @classmethod
+    async def aserve(cls,factory,host,direct=False)->asyncio.AbstractServer:
+        raise NotImplementedError()
     async def aconnecct(self,host):
         raise NotImplementedError()
 class ServiceTable(dict):
@@ -146,16 +374,16 @@ class ServiceTable(dict):
         if self.factory.superservice and request_context.Service != (
             superservice := self.factory.superservice
         ):
-            superservice: Service = self.factory.superservice
+            factory = self.factory
 
             return type(
                 name,
                 (),
                 {
                     "__getitem__": lambda self, n: functools.partial(
-                        superservice.call, name, n
+                        factory.call, name, n
                     ),
-                    "__getattr__": lambda self, n: lambda **x: superservice.call(
+                    "__getattr__": lambda self, n: lambda **x: factory.call(
                         name, n, x
                     ),
                 },
@@ -174,11 +402,28 @@ class ServiceTable(dict):
         return self._get(name)
 
 class TcpTransport(Transport):
-    def __init__(self,factory):
-        super().__init__(factory)
+    # Gather the calls made in the same loop iteration into one "batch" frame
+    batch = bool(os.getenv("VCC_RPC_BATCH"))
+    # Requests of one connection served at the same time, None for no limit,
+    # and how many more may wait before the peer gets "overloaded" errors
+    max_requests = int(os.environ["VCC_RPC_MAX_REQUESTS"]) if "VCC_RPC_MAX_REQUESTS" in os.environ else None
+    max_queued = int(os.getenv("VCC_RPC_MAX_QUEUED", 0))
+    # High and low watermarks of the write buffer, None keeps the asyncio defaults
+    write_buffer_limits = (
+        (int(os.environ["VCC_RPC_WRITE_HIGH"]), int(os.getenv("VCC_RPC_WRITE_LOW", 0)) or None)
+        if "VCC_RPC_WRITE_HIGH" in os.environ
+        else None
+    )
+
+    def __init__(self,factory,direct=False):
+        super().__init__(factory,direct)
         self.status=TransportStatus.CONNECTING
         self.host=(None,None )
         self._send:typing.Callable|None=None
+        self.protocol:TcpTransportProtocol|None=None
+        self._batch:list[tuple[dict[str,typing.Any],metrics.MethodStats]]=[]
+        self.active=0
+        self._semaphore=asyncio.Semaphore(self.max_requests) if self.max_requests is not None else None
     @property
     def send(self)->typing.Callable:
         def send(self,*_,**__):
@@ -190,67 +435,200 @@ class TcpTransport(Transport):
     def set_send(self,value):
         self._send=value
 
-    def make_respond(self, jobid, data):
+    def make_respond(self, jobid, data, size=0):
         try:
-            self.jobs[jobid].set_result(data)
+            self.jobs[jobid].set_result((data, size))
         except:
             return
-    async def call(self, namespace, service, kwargs):
+    def send_cancel(self, jobid):
+        for i, (obj, _) in enumerate(self._batch):
+            if obj["jobid"] == jobid:
+                # Not sent yet
+                del self._batch[i]
+                return
+        if self.status == TransportStatus.CONNECTED:
+            self.send(type="cancel", jobid=jobid)
+    def cancel_request(self, jobid):
+        if (task := self.requests.get(jobid)) is not None:
+            task.cancel()
+    def send_call(self, stats: metrics.MethodStats, **obj):
+        # Only peers which switched to frames understand batches
+        if not self.batch or self.protocol is None or not self.protocol.framed_write:
+            stats.request_bytes += self.send(**obj) or 0
+            return
+        if not self._batch:
+            asyncio.get_running_loop().call_soon(self.flush_batch)
+        self._batch.append((obj, stats))
+    def flush_batch(self):
+        batch, self._batch = self._batch, []
+        if len(batch) == 1:
+            obj, stats = batch[0]
+            stats.request_bytes += self.send(**obj) or 0
+            return
+        size = self.send(type="batch", calls=[obj for obj, _ in batch]) or 0
+        for _, stats in batch:
+            stats.request_bytes += size // len(batch)
+    async def call(self, namespace, service, kwargs, timeout=None):
         if self.status!=TransportStatus.CONNECTED:
             return RuntimeError("This Transport havn't be connected")
         log.debug(f"Request to rpc: {namespace=} {service=} {kwargs=}")
+        timeout = self.factory.get_timeout(namespace, timeout)
+        if timeout is not None and timeout <= 0:
+            raise tools.DeadlineExceededError(f"{namespace}.{service}")
         jobid = str(uuid.uuid4())
         future = asyncio.Future()
         self.jobs[jobid] = future
         if call_verbose:
             print(f'Call {namespace}.{service}({kwargs}) with jobid {jobid}')
-        self.send(
-            type="call", jobid=jobid, namespace=namespace, service=service, data=kwargs
-        )
-        ret= await future
-
-        del self.jobs[jobid]
+        stats = self.factory.metrics.call(namespace, service)
+        start = stats.start()
+        ret, size = None, 0
+        try:
+            if self.protocol is not None and self.protocol.write_paused:
+                await asyncio.wait_for(self.protocol.drain(), timeout)
+            self.send_call(
+                stats, type="call", jobid=jobid, namespace=namespace, service=service, data=kwargs,
+                **({} if timeout is None else {"timeout": timeout})
+            )
+            ret, size = await asyncio.wait_for(future, timeout)
+            if isinstance(ret, RpcStream) and timeout is not None:
+                ret.deadline = asyncio.get_running_loop().time() + timeout - (time.perf_counter() - start)
+        except asyncio.TimeoutError:
+            stats.finish(start, error=True)
+            self.send_cancel(jobid)
+            raise tools.DeadlineExceededError(f"{namespace}.{service}") from None
+        except asyncio.CancelledError:
+            stats.finish(start, error=True)
+            self.send_cancel(jobid)
+            raise
+        except BaseException:
+            stats.finish(start, error=True)
+            raise
+        finally:
+            self.jobs.pop(jobid, None)
+        stats.finish(start, size)
         return ret
 
-    async def do_request(self, data):
+    async def do_batch(self, data, size=0):
+        """Run the calls of a batch concurrently and answer them with one batch"""
+        calls = data["calls"]
+        responses = []
+        if not calls:
+            self.send(type="batch", responses=responses)
+            return
+        respond = lambda **obj: responses.append(obj)
+        await asyncio.gather(
+            *(self.do_request(call, size // len(calls), respond) for call in calls),
+            return_exceptions=True,
+        )
+        self.send(type="batch", responses=responses)
+
+    async def do_request(self, data, size=0, send=None):
+        send = send or self.send
         service = data["service"]
         namespace = data["namespace"]
         if call_verbose:
             print(f'1Call {namespace}.{service}({data["data"]}) with jobid {data["jobid"]}')
         request_context.Service=self
+        # Calls made while serving this one inherit what is left of its deadline
+        request_context.deadline=deadline=(
+            asyncio.get_running_loop().time() + data["timeout"] if "timeout" in data else None
+        )
+        stats = self.factory.metrics.request(namespace, service)
+        start = stats.start(size)
         try:
             func = self.factory.services[namespace][service]
-            print(func)
         except KeyError:
-            self.send(
+            stats.finish(start, send(
                 res="error",
                 error=f"no such service {namespace}.{service}",
                 data=None,
                 jobid=data["jobid"],
-            )
+            ) or 0, error=True)
             return
 
         # FIXME:Dont do the fucking param check and the code will work
         # if len(param.keys())!=getattr(func,"__code__",func).co_argcount-1:
         #     self.send({"res": "error", "error": "wrong format","jobid": data["jobid"]})
         #     return
+        if self.max_requests is not None and self.active >= self.max_requests + self.max_queued:
+            stats.finish(start, send(
+                res="error",
+                error="overloaded",
+                data=None,
+                jobid=data["jobid"],
+            ) or 0, error=True)
+            return
+        self.active += 1
+        if (task := asyncio.current_task()) is not None:
+            self.requests[data["jobid"]] = task
         try:  # FIXME: This try-except may make debug hard
-            resp = await func(**data["data"])
-            print(resp)
-            self.send(type="respond", data=resp, jobid=data["jobid"])
-        except Exception:
+            resp = await asyncio.wait_for(self._run(func, data["data"]), data.get("timeout"))
+            if isinstance(resp, collections.abc.AsyncIterator):
+                stats.finish(start, await asyncio.wait_for(
+                    self.send_stream(data["jobid"], resp, send),
+                    None if deadline is None else deadline - asyncio.get_running_loop().time(),
+                ))
+            else:
+                stats.finish(start, send(type="respond", data=resp, jobid=data["jobid"]) or 0)
+        except asyncio.CancelledError:
+            # Cancelled, the caller doesn't wait for an answer any more
+            stats.finish(start, error=True)
+        except tools.OverloadedError:
+            # Pass it on, the service behind this one is overloaded
+            stats.finish(start, send(
+                res="error",
+                error="overloaded",
+                data=None,
+                jobid=data["jobid"],
+            ) or 0, error=True)
+        except Exception as e:
+            if (
+                isinstance(e, asyncio.TimeoutError)
+                and deadline is not None
+                and asyncio.get_running_loop().time() >= deadline
+            ):
+                # Expired, the caller doesn't wait for an answer any more.
+                # A TimeoutError of the export itself (socket, redis...) is a server error
+                stats.finish(start, error=True)
+                return
             traceback.print_exc()
-            self.send(
+            stats.finish(start, send(
                 res="error",
                 error="server error",
                 data=traceback.format_exc(),
                 jobid=data["jobid"],
-            )
+            ) or 0, error=True)
+        finally:
+            self.active -= 1
+            self.requests.pop(data["jobid"], None)
+    async def send_stream(self, jobid, stream, send) -> int:
+        """Send every item of an async iterator as a "chunk" frame, then an "end" frame"""
+        try:
+            if self.protocol is None or not self.protocol.framed_write:
+                # Peers talking lines only understand one response
+                return send(type="respond", data=[i async for i in stream], jobid=jobid) or 0
+            size = 0
+            try:
+                async for item in stream:
+                    await self.protocol.drain()
+                    size += self.send(type="chunk", data=item, jobid=jobid)
+            except Exception:
+                traceback.print_exc()
+                return size + self.send(type="end", error="server error", jobid=jobid)
+            return size + self.send(type="end", jobid=jobid)
+        finally:
+            if hasattr(stream, "aclose"):
+                await stream.aclose()
+    async def _run(self, func, kwargs):
+        if self._semaphore is None:
+            return await func(**kwargs)
+        async with self._semaphore:
+            return await func(**kwargs)
     async def reconnect(self):
         assert self.host!=(None,None)
         self.status=TransportStatus.CONNECTING
-        for i in self.jobs.values():
-            i.set_exception(RuntimeError("Connection closed"))
+        self.fail_jobs(RuntimeError("Connection closed"))
         await self.aconnecct(self.host)
     async def aconnecct(self,host):
         loop = asyncio.get_running_loop()
@@ -260,53 +638,171 @@ class TcpTransport(Transport):
             functools.partial(TcpTransportProtocol, self, RpcServiceRole.CLIENT), *host
         )
     @classmethod
+    async def aserve(cls, factory, host, direct=False):
+        loop = asyncio.get_running_loop()
+        return await loop.create_server(
+            lambda :TcpTransportProtocol(cls(factory, direct), RpcServiceRole.SERVER),
+            *host
+        )
+    @classmethod
     async def alisten(cls, factory,host):
+        return await (await cls.aserve(factory, host)).serve_forever()
+class UnixTransport(TcpTransport):
+    """Same protocol as TcpTransport over a unix socket, host is (path,)"""
+    async def aconnecct(self,host):
         loop = asyncio.get_running_loop()
-        return await (
-            await loop.create_server(
-                lambda :TcpTransportProtocol(cls(factory), RpcServiceRole.SERVER),
-                *host
-            )
-        ).serve_forever()
+        self.host=host
+        log.debug(f"connecting to {host}")
+        transport, protocol = await loop.create_unix_connection(
+            functools.partial(TcpTransportProtocol, self, RpcServiceRole.CLIENT), *host
+        )
+    @classmethod
+    async def aserve(cls, factory, host, direct=False):
+        loop = asyncio.get_running_loop()
+        return await loop.create_unix_server(
+            lambda :TcpTransportProtocol(cls(factory, direct), RpcServiceRole.SERVER),
+            *host
+        )
 class TcpTransportProtocol(lineReceiver):
+    """
+    Handshake:
+    server: {"type": "connect", "capacity": [...], "framing": ["length"], "codecs": [...]} (line)
+    client: {"type": "upgrade", "framing": "length", "codec": "json"} (line, then writes frames)
+    server: {"type": "upgrade", "framing": "length", "codec": "json"} (line, then reads and writes frames)
+    Peers which don't know about "framing" just keep using lines.
+    Framed peers also accept {"type": "batch", "calls": [...]} and answer it
+    with {"type": "batch", "responses": [...]}, and answer calls of async
+    generators with {"type": "chunk", ...} frames and a final {"type": "end", ...}.
+
+    When the write buffer is above its high watermark, new calls wait for it
+    to drain and the server side stops reading requests until then.
+    """
+
+    write_paused = False
+    _drain_waiter: asyncio.Future | None = None
+
     def __init__(self,transport:TcpTransport,role):
         self.transport:TcpTransport=transport
         self.role=role
         self.factory=transport.factory
-    def send(self, **obj):
-        self.sendLine(bytes(json.dumps(obj), "UTF8"))
+        self.codec="json"
+    def send(self, **obj) -> int:
+        if self.framed_write:
+            return self.sendFrame(codecs[self.codec].dumps(obj))
+        return self.sendLine(tools.json_codec.dumps(obj))
     def connection_made(self, transport):
         super().connection_made(transport)
+        if self.transport.write_buffer_limits is not None:
+            transport.set_write_buffer_limits(*self.transport.write_buffer_limits)
         self.transport._send=self.send
+        self.transport.protocol=self
         self.transport.status=TransportStatus.CONNECTED
         if self.role == RpcServiceRole.SERVER:
             capacity=list(dict.get(self.factory.services,"rpc",{}).keys())
-            self.send(type="connect",  capacity=capacity)
+            self.send(type="connect",  capacity=capacity, framing=["length"], codecs=list(codecs))
+    def pause_writing(self):
+        self.write_paused = True
+        if self.role == RpcServiceRole.SERVER:
+            # Only one side stops reading, so that two full buffers can't wait on each other
+            self.connection.pause_reading()
+    def resume_writing(self):
+        self.write_paused = False
+        if self.role == RpcServiceRole.SERVER and not self.connection.is_closing():
+            self.connection.resume_reading()
+        if self._drain_waiter is not None:
+            if not self._drain_waiter.done():
+                self._drain_waiter.set_result(None)
+            self._drain_waiter = None
+    async def drain(self):
+        if not self.write_paused:
+            return
+        if self._drain_waiter is None:
+            self._drain_waiter = asyncio.get_running_loop().create_future()
+        await asyncio.shield(self._drain_waiter)
     def connection_lost(self, exc: Exception | None):
-        if self.role == RpcServiceRole.CLIENT:
+        if self.write_paused:
+            self.resume_writing()
+        if self.role == RpcServiceRole.CLIENT and self.transport.direct:
+            self.factory.remove_direct(self.transport)
+        elif self.role == RpcServiceRole.CLIENT:
              asyncio.create_task(asyncio.sleep(2)).add_done_callback(lambda _:asyncio.create_task(self.transport.reconnect()))
-        #pass
-    async def do_request(self,data):
-        await self.transport.do_request(data)
+        else:
+            self.transport.status = TransportStatus.ERROR
+            self.transport.fail_jobs(RuntimeError("Connection closed"))
+            self.factory.remove_connection(self.transport)
+    async def do_request(self,data,size=0):
+        await self.transport.do_request(data,size)
+    async def do_batch(self,data,size=0):
+        await self.transport.do_batch(data,size)
+    def upgrade(self, data):
+        if data.get("framing") != "length" or data.get("codec") not in codecs:
+            return
+        self.codec = data["codec"]
+        if self.role == RpcServiceRole.SERVER:
+            # Everything after the upgrade line is framed
+            self.framed_read = True
+            self.send(type="upgrade", framing="length", codec=self.codec)
+            self.framed_write = True
+        else:
+            self.framed_read = True
     def line_received(self, data):
+        size = len(data)
         try:
-            data = json.loads(data)
-            log.debug(data)
-        except json.JSONDecodeError:
+            data = tools.json_codec.loads(data)
+        except ValueError:
             self.send(res="error", error="not json")
             return
+        self.message_received(data, size)
+    def frame_received(self, data):
+        size = FRAME_HEADER.size + len(data)
+        try:
+            data = codecs[self.codec].loads(data)
+        except Exception:
+            log.warning("undecodable frame", exc_info=True)
+            self.send(res="error", error=f"not {self.codec}")
+            return
+        self.message_received(data, size)
+    def message_received(self, data, size=0):
+        log.debug(data)
         if "res" in data:
+            if data.get("error") == "overloaded":
+                self.transport.make_error(data["jobid"], tools.OverloadedError())
             return
         match data.get("type", None):
             case "call":
-                asyncio.create_task(self.do_request(data))
+                asyncio.create_task(self.do_request(data, size))
+            case "cancel":
+                self.transport.cancel_request(data["jobid"])
+            case "chunk":
+                self.transport.make_chunk(data["jobid"], data["data"], size)
+            case "end":
+                self.transport.end_stream(data["jobid"], data.get("error"))
+            case "batch" if "calls" in data:
+                asyncio.create_task(self.do_batch(data, size))
+            case "batch":
+                for i in data["responses"]:
+                    if i.get("error") == "overloaded":
+                        self.transport.make_error(i["jobid"], tools.OverloadedError())
+                    elif "res" not in i:
+                        self.transport.make_respond(i["jobid"], i["data"], size // len(data["responses"]))
             case "connect":
                 if self.role == RpcServiceRole.CLIENT:
+                    self.transport.capacity = data["capacity"]
+                    if "length" in data.get("framing", []):
+                        codec = os.getenv("VCC_RPC_CODEC", "json")
+                        if codec not in codecs or codec not in data.get("codecs", []):
+                            codec = "json"
+                        self.send(type="upgrade", framing="length", codec=codec)
+                        self.codec = codec
+                        self.framed_write = True
                     if "register" in data["capacity"]:
-                        print(self.factory.services.rpc)
-                        asyncio.get_running_loop().create_task(self.factory.services.rpc.register(namespace=list(self.factory.services.keys())))
+                        # Routers which can hand out addresses also accept them
+                        address = {"address": self.factory.address} if self.factory.address and "lookup" in data["capacity"] else {}
+                        asyncio.get_running_loop().create_task(self.factory.services.rpc.register(namespace=list(self.factory.services.keys()), **address))
+            case "upgrade":
+                self.upgrade(data)
             case "respond":
-                self.transport.make_respond(data["jobid"], data["data"])
+                self.transport.make_respond(data["jobid"], data["data"], size)
 
 
 class RpcServiceFactory:
@@ -315,9 +811,25 @@ class RpcServiceFactory:
     def register_transport(cls,transport:type[Transport],name:str):
         cls.transports[name]=transport
     superservice: Transport | None = property(lambda self: tools.list_get_default(self.connections,0) if len(self.connections)==1 else None)
+    # Call providers through direct connections instead of the router when possible
+    direct = bool(os.getenv("VCC_RPC_DIRECT"))
+    # Seconds before asking the router again for a namespace without direct provider
+    direct_retry = 10
+    # Seconds a call may take unless its namespace is in timeouts, None waits forever
+    default_timeout = float(os.environ["VCC_RPC_TIMEOUT"]) if "VCC_RPC_TIMEOUT" in os.environ else None
     def __init__(self):
         self.services = ServiceTable(self)
+        self.timeouts: dict[str, float] = {}
+        # Executors of the registered services, see register
+        self.pools: dict[str, dict[str, ServicePool]] = {}
         self.connections = []
+        self.metrics = metrics.RpcMetrics(self)
+        # Address announced to the router for direct connections, see VCC_RPC_DIRECT_LISTEN
+        self.address: tuple[str, int] | None = None
+        self.direct_connections: dict[tuple[str, int], Transport] = {}
+        self.direct_namespaces: dict[str, Transport] = {}
+        self._direct_retry: dict[str, float] = {}
+        self._direct_lookups: dict[str, asyncio.Task] = {}
         # service={<namespace>:{<service>:[<annotations>,<ServiceExport>/<RemoteExport>]}}
 
     # def clientConnectionFailed(self, connector, reason):
@@ -328,6 +840,81 @@ class RpcServiceFactory:
     #     log.debug(reason)
     #     self.done.callback(None)
 
+    async def call(self, namespace, service, kwargs, timeout=None):
+        """
+        Call a remote service, through a direct connection to its provider if
+        there is one, otherwise through the router.
+        A direct call which was already sent isn't retried if the connection dies.
+        """
+        if self.direct and namespace != "rpc":
+            transport = await self.get_direct(namespace)
+            if transport is not None and transport.status == TransportStatus.CONNECTED:
+                return await transport.call(namespace, service, kwargs, timeout)
+        return await typing.cast(Transport, self.superservice).call(namespace, service, kwargs, timeout)
+
+    def get_timeout(self, namespace, timeout=None) -> float | None:
+        """
+        Seconds a call may take: the given timeout, or the one of the namespace,
+        but never longer than what is left of the request being served.
+        """
+        if timeout is None:
+            timeout = self.timeouts.get(namespace, self.default_timeout)
+        if (deadline := request_context.deadline) is not None:
+            remaining = deadline - asyncio.get_running_loop().time()
+            timeout = remaining if timeout is None else min(timeout, remaining)
+        return timeout
+
+    async def get_direct(self, namespace) -> Transport | None:
+        if (transport := self.direct_namespaces.get(namespace)) is not None:
+            return transport
+        if time.monotonic() < self._direct_retry.get(namespace, 0):
+            return None
+        if (task := self._direct_lookups.get(namespace)) is None:
+            task = self._direct_lookups[namespace] = asyncio.create_task(
+                self._lookup_direct(namespace)
+            )
+            task.add_done_callback(lambda _: self._direct_lookups.pop(namespace, None))
+        return await asyncio.shield(task)
+
+    async def _lookup_direct(self, namespace) -> Transport | None:
+        router = self.superservice
+        try:
+            if router is not None and "lookup" in router.capacity:
+                addresses = await router.call("rpc", "lookup", {"namespace": namespace})
+                random.shuffle(addresses)
+                for address in map(tuple, addresses):
+                    if (transport := self.direct_connections.get(address)) is None:
+                        transport = self.transports["tcp"](self, direct=True)
+                        try:
+                            await transport.aconnecct(address)
+                        except OSError:
+                            log.warning(f"direct connection to {address} failed", exc_info=True)
+                            continue
+                        self.direct_connections[address] = transport
+                    self.direct_namespaces[namespace] = transport
+                    return transport
+        except Exception:
+            log.warning(f"lookup of {namespace} failed", exc_info=True)
+        self._direct_retry[namespace] = time.monotonic() + self.direct_retry
+        return None
+
+    def remove_direct(self, connection: Transport):
+        connection.fail_jobs(RuntimeError("Connection closed"))
+        for address, transport in list(self.direct_connections.items()):
+            if transport is connection:
+                del self.direct_connections[address]
+        for namespace, transport in list(self.direct_namespaces.items()):
+            if transport is connection:
+                del self.direct_namespaces[namespace]
+
+    def remove_connection(self, connection: Transport):
+        """Forget a dead connection, and every namespace only it provided"""
+        if connection in self.connections:
+            self.connections.remove(connection)
+        for name, export in list(self.services.items()):
+            if isinstance(export, RemoteExport) and export.remove_connection(connection) == 0:
+                del self.services[name]
+
     @staticmethod
     def create_meta_info(func_map: dict[str, typing.Callable[..., typing.Any]]):
         return {
@@ -344,7 +931,11 @@ class RpcServiceFactory:
             ]
         }
 
-    def register(self, instance, name=None, async_mode=False):
+    def register(self, instance, name=None, async_mode=False, threads=None, processes=None):
+        """
+        :param threads: Run the sync exports in a pool of that many threads instead of the event loop
+        :param processes: Size of a process pool for exports with process=True and run_in_process
+        """
         if name is None:
             name = type(instance).__name__.lower()
         if hasattr(instance, "exports") or hasattr(instance, "exports_async"):
@@ -363,12 +954,29 @@ class RpcServiceFactory:
                 if i[0] != "_" and callable(getattr(instance, i))
             }
 
+        pools = {}
+        if threads is not None:
+            pools["thread"] = ServicePool(
+                concurrent.futures.ThreadPoolExecutor(threads, thread_name_prefix=name), threads
+            )
+        if processes is not None:
+            pools["process"] = ServicePool(
+                concurrent.futures.ProcessPoolExecutor(processes), processes
+            )
+        if pools:
+            self.pools[name] = pools
+            for export in func.values():
+                if isinstance(export, ServiceExport):
+                    export.executor = pools.get("thread")
+                    export.process_executor = pools.get("process")
+
         meta_info = self.create_meta_info(func)
 
         def get_meta_info():
             return meta_info
 
         func["get_meta_info"] = get_meta_info  # type: ignore
+        func["get_stats"] = ServiceExport(self.metrics.snapshot)
 
         annotations = {
             key1: {
@@ -380,13 +988,27 @@ class RpcServiceFactory:
         }
         self.services.update({name: func})
         # self.funcs.update(services)
-    async def aconnect(self, host=tools.get_host(),protocol="tcp",block=False):
-        transport=self.transports[protocol](self)
+    async def aconnect(self, host=None,protocol=None,block=False):
+        """Without host, connect to the rpc server in RPCHOST, see tools.get_rpc_address"""
+        if host is None:
+            default_protocol, host = tools.get_rpc_address()
+            protocol = protocol or default_protocol
+        metrics.install_signal_handler(asyncio.get_running_loop())
+        if self.address is None and "VCC_RPC_DIRECT_LISTEN" in os.environ:
+            # Accept direct connections from other services, port 0 picks a free one
+            listen_host, listen_port = os.environ["VCC_RPC_DIRECT_LISTEN"].rsplit(":", 1)
+            server = await self.transports["tcp"].aserve(self, (listen_host, int(listen_port)), direct=True)
+            self.address = (listen_host, server.sockets[0].getsockname()[1])
+        transport=self.transports[protocol or "tcp"](self)
         await transport.aconnecct(host=host,)
         if block:
             await asyncio.Future()
-    async def alisten(self, host=tools.get_host(),protocol="tcp"):
-        return await self.transports[protocol].alisten(self,host)
+    async def alisten(self, host=None,protocol=None):
+        if host is None:
+            default_protocol, host = tools.get_rpc_address()
+            protocol = protocol or default_protocol
+        metrics.install_signal_handler(asyncio.get_running_loop())
+        return await self.transports[protocol or "tcp"].alisten(self,host)
 
     def connect(self, *args, **kwargs):
         asyncio.run(self.aconnect(*args,block=True,**kwargs))
@@ -419,3 +1041,4 @@ def metadata(
     return func
 
 RpcServiceFactory.register_transport(TcpTransport,"tcp")
+RpcServiceFactory.register_transport(UnixTransport,"unix")
@@ -1,12 +1,26 @@
+import asyncio
+import bisect
+import hashlib
 import inspect
+import json
 import logging
 import os
 import contextvars
 import copy
-from functools import wraps
-from typing import TYPE_CHECKING, Any, Awaitable, Callable, Literal, TypeVar, TypedDict
+from functools import partial, wraps
+from typing import TYPE_CHECKING, Any, Awaitable, Callable, Literal, NamedTuple, TypeVar, TypedDict
 from typing_extensions import NotRequired
 
+try:
+    import orjson
+except ImportError:
+    orjson = None
+
+try:
+    import msgpack
+except ImportError:
+    msgpack = None
+
 if TYPE_CHECKING:
     from .vcc import RpcExchangerBaseClient
 
@@ -57,6 +71,18 @@ class ProviderNotFoundError(RpcException):
     pass
 
 
+class DeadlineExceededError(RpcException):
+    pass
+
+
+class OverloadedError(RpcException):
+    pass
+
+
+class ClientOverflowError(RpcException):
+    pass
+
+
 class RedisMessage(TypedDict):
     username: str
     msg_type: str
@@ -68,7 +94,7 @@ class RedisMessage(TypedDict):
     time: int
 
 
-Event = Literal["join", "quit", "kick", "rename", "invite"]
+Event = Literal["join", "quit", "kick", "rename", "invite", "permission_changed"]
 
 MessageCallback = Callable[
     [int, str, str, int, str | None, str], None | Awaitable[None]
@@ -80,6 +106,8 @@ class RedisEvent(TypedDict):
     type: Event
     data: Any
     chat: int
+    # Which chat service published it, see ChatService._forget_changed
+    origin: NotRequired[str]
 
 class FriendRequest(TypedDict):
     sender: int
@@ -120,6 +148,46 @@ class ContextObject(object):
         self._context.set(self._context.get() | {name: value})
 
 
+def _positions(func: Callable) -> tuple[inspect.Signature, list[str] | None]:
+    """
+    Names of the parameters after self, in order. None if the signature has
+    anything the fast paths below can't handle (*args, **kwargs, positional only)
+    """
+    signature = inspect.signature(func)
+    names = list(signature.parameters)[1:]
+    for parameter in list(signature.parameters.values())[1:]:
+        if parameter.kind is not inspect.Parameter.POSITIONAL_OR_KEYWORD:
+            return signature, None
+    return signature, names
+
+
+def _argument_getter(func: Callable, name: str) -> Callable[[tuple, dict], Any]:
+    signature, names = _positions(func)
+    if names is None or name not in names:
+
+        def slow_get(args: tuple, kwargs: dict):
+            return signature.bind(None, *args, **kwargs).arguments[name]
+
+        return slow_get
+    position = names.index(name)
+
+    def get(args: tuple, kwargs: dict):
+        if len(args) > position:
+            return args[position]
+        return kwargs[name]
+
+    return get
+
+
+def _copier(value: Any) -> Callable[[], Any]:
+    # Only the empty containers used by the clients are hot, deepcopy the rest
+    if value is None or isinstance(value, (bool, int, float, str, bytes)):
+        return lambda: value
+    if type(value) in (list, dict, set) and not value:
+        return type(value)
+    return partial(copy.deepcopy, value)
+
+
 def check(
     *,
     auth: bool = True,
@@ -128,26 +196,39 @@ def check(
     error_return: Any = Exception,
 ):
     def decorator(func: T) -> T:
-        signature = inspect.signature(func)
+        get_joined = _argument_getter(func, joined) if joined is not None else None
+        get_not_joined = (
+            _argument_getter(func, not_joined) if not_joined is not None else None
+        )
+        make_error_return = _copier(error_return)
+
+        if get_joined is None and get_not_joined is None:
+
+            @wraps(func)
+            async def wrapper(self: "RpcExchangerBaseClient", *args, **kwargs):
+                if auth:
+                    self.check_authorized()
+                return await func(self, *args, **kwargs)
+
+            return wrapper  # type: ignore
 
         @wraps(func)
-        async def wrapper(self: "RpcExchangerBaseClient", *args, **kwargs):
-            bound_signature = signature.bind(self, *args, **kwargs)
+        async def checked_wrapper(self: "RpcExchangerBaseClient", *args, **kwargs):
             if auth:
                 self.check_authorized()
             try:
-                if joined is not None:
-                    await self.check_joined(bound_signature.arguments[joined])
-                if not_joined is not None:
-                    await self.check_not_joined(bound_signature.arguments[not_joined])
+                if get_joined is not None:
+                    await self.check_joined(get_joined(args, kwargs))
+                if get_not_joined is not None:
+                    await self.check_not_joined(get_not_joined(args, kwargs))
             except RpcException as e:
                 log.warning(e, exc_info=True)
                 if error_return is Exception:
                     raise
-                return copy.deepcopy(error_return)
+                return make_error_return()
             return await func(self, *args, **kwargs)
 
-        return wrapper  # type: ignore
+        return checked_wrapper  # type: ignore
 
     return decorator
 
@@ -159,17 +240,47 @@ def rpc_request(_service: str | None = None, *, id_arg: str | None = None):
             if _service is not None
             else func.__name__.split("_", 1)
         )
-        signature = inspect.signature(func)
+        signature, names = _positions(func)
+
+        if names is None:
+
+            @wraps(func)
+            def slow_wrapper(self: "RpcExchangerBaseClient", *args, **kwargs):
+                log.debug(f"{namespace=} {service=} {id_arg=} {args=} {kwargs=}")
+                bound_signature = signature.bind(self, *args, **kwargs)
+                bound_signature.apply_defaults()
+                arguments = bound_signature.arguments
+                if id_arg is not None:
+                    arguments.update({id_arg: self._id})
+                del arguments["self"]
+                return self._exchanger.rpc_request(namespace, service, arguments)
+
+            return slow_wrapper  # type: ignore
+
+        defaults = {
+            name: parameter.default
+            for name, parameter in signature.parameters.items()
+            if name in names and parameter.default is not inspect.Parameter.empty
+        }
+        count = len(names)
+        known = frozenset(names)
 
         @wraps(func)
         def wrapper(self: "RpcExchangerBaseClient", *args, **kwargs):
-            log.debug(f"{namespace=} {service=} {id_arg=} {args=} {kwargs=}")
-            bound_signature = signature.bind(self, *args, **kwargs)
-            bound_signature.apply_defaults()
-            arguments = bound_signature.arguments
+            if log.isEnabledFor(logging.DEBUG):
+                log.debug(f"{namespace=} {service=} {id_arg=} {args=} {kwargs=}")
+            arguments = dict(zip(names, args))
+            if kwargs:
+                if not arguments.keys().isdisjoint(kwargs) or not known.issuperset(kwargs):
+                    signature.bind(self, *args, **kwargs)  # raises the TypeError
+                arguments.update(kwargs)
+            if len(arguments) != count or len(args) > count:
+                for name, value in defaults.items():
+                    arguments.setdefault(name, value)
+                if len(arguments) != count or len(args) > count:
+                    signature.bind(self, *args, **kwargs)
             if id_arg is not None:
-                arguments.update({id_arg: self._id})
-            del arguments["self"]
+                arguments[id_arg] = self._id
             return self._exchanger.rpc_request(namespace, service, arguments)
 
         return wrapper  # type: ignore
@@ -177,21 +288,270 @@ def rpc_request(_service: str | None = None, *, id_arg: str | None = None):
     return decorator
 
 
+class Codec(NamedTuple):
+    """Turns objects into bytes and back, name is the format on the wire"""
+
+    name: str
+    dumps: Callable[[Any], bytes]
+    loads: Callable[[bytes | memoryview | str], Any]
+
+
+def _json_loads(data: bytes | memoryview | str) -> Any:
+    return json.loads(bytes(data) if isinstance(data, memoryview) else data)
+
+
+# The stdlib is the fallback, orjson is used when installed unless VCC_JSON=json
+if orjson is not None and os.getenv("VCC_JSON", "orjson") == "orjson":
+    json_codec = Codec(
+        "json", partial(orjson.dumps, option=orjson.OPT_NON_STR_KEYS), orjson.loads
+    )
+else:
+    json_codec = Codec("json", lambda obj: json.dumps(obj).encode(), _json_loads)
+
+codecs: dict[str, Codec] = {"json": json_codec}
+if msgpack is not None:
+    codecs["msgpack"] = Codec(
+        "msgpack", msgpack.packb, partial(msgpack.unpackb, strict_map_key=False)
+    )
+
+
+def get_codec(name: str | None = None) -> Codec:
+    """The codec called name, by default the one of VCC_CODEC, json if it isn't available"""
+    name = name or os.getenv("VCC_CODEC", "json")
+    if name not in codecs:
+        log.warning(f"codec {name} isn't available, using json")
+        return json_codec
+    return codecs[name]
+
+
+# Messages on the redis bus other than json are b"\0" + BUS_VERSION + codec name + b"\0" + body.
+# json stays untagged, so that nodes from before the tag can read it during a rollout.
+BUS_VERSION = 1
+
+
+def encode_bus(obj: Any, codec: Codec | None = None) -> bytes:
+    codec = codec or get_codec()
+    data = codec.dumps(obj)
+    if codec.name == "json":
+        return data
+    return b"\0" + bytes([BUS_VERSION]) + codec.name.encode() + b"\0" + data
+
+
+def decode_bus(data: bytes) -> Any:
+    if data[:1] != b"\0":
+        return json_codec.loads(data)
+    end = data.index(b"\0", 2)
+    name = data[2:end].decode()
+    if data[1] != BUS_VERSION or name not in codecs:
+        raise ValueError(f"unsupported bus message: version {data[1]}, codec {name}")
+    return codecs[name].loads(memoryview(data)[end + 1 :])
+
+
 def list_get_default(l, index, default=None):
     return l[index] if index < len(l) else default
 
 
 def get_host() -> tuple[str, int]:
-    if "RPCHOST" in os.environ:
+    if "RPCHOST" in os.environ and not os.environ["RPCHOST"].startswith("unix:"):
         host = os.environ["RPCHOST"].split(":")
         return host[0], int(host[1])
     else:
         return ("localhost", 2474)
 
+
+# Publish chat traffic on `messages:<chat>` / `events:<chat>` instead of one channel for everything
+chat_channels = bool(os.getenv("VCC_CHAT_CHANNELS"))
+
+
+def get_channel(kind: Literal["messages", "events"], chat: int) -> str:
+    return f"{kind}:{chat}" if chat_channels else kind
+
+
+# How messages and events travel between nodes: "pubsub", or "streams" to keep
+# them in capped redis streams which readers resume from after a reconnect
+bus = os.getenv("VCC_BUS", "pubsub")
+stream_shards = int(os.getenv("VCC_STREAM_SHARDS", 1))
+stream_maxlen = int(os.getenv("VCC_STREAM_MAXLEN", 100000))
+
+
+def get_stream(kind: Literal["messages", "events"], chat: int) -> str:
+    return f"stream:{kind}:{chat % stream_shards}"
+
+
+def get_streams(kind: Literal["messages", "events"]) -> list[str]:
+    return [f"stream:{kind}:{i}" for i in range(stream_shards)]
+
+
+def publish_bus(redis: Any, kind: Literal["messages", "events"], chat: int, data: bytes) -> Any:
+    """
+    Publish data encoded by encode_bus, redis can be a client or a pipeline.
+    Returns what the redis command returns.
+    """
+    if bus == "streams":
+        return redis.xadd(
+            get_stream(kind, chat), {"data": data}, maxlen=stream_maxlen, approximate=True
+        )
+    return redis.publish(get_channel(kind, chat), data)
+
+
+def get_redis_urls(url: str | None = None) -> list[str]:
+    """
+    Redis instances the bus is sharded across, from REDIS_URL separated by commas.
+    Every node has to list them in the same order.
+    """
+    url = os.getenv("REDIS_URL", "redis://localhost:6379") if url is None else url
+    return [i.strip() for i in url.split(",") if i.strip()]
+
+
+def _ring_hash(key: str) -> int:
+    return int.from_bytes(hashlib.md5(key.encode()).digest()[:8], "big")
+
+
+class HashRing:
+    """
+    Consistent hashing of chats onto `size` shards, adding a shard at the end
+    only moves about 1/size of the chats
+    """
+
+    replicas = int(os.getenv("VCC_RING_REPLICAS", 160))
+
+    def __init__(self, size: int):
+        self.size = size
+        points = sorted(
+            (_ring_hash(f"shard-{shard}-{i}"), shard)
+            for shard in range(size)
+            for i in range(self.replicas)
+        )
+        self._hashes = [hash for hash, _ in points]
+        self._shards = [shard for _, shard in points]
+        self._cache: dict[int, int] = {}
+
+    def get(self, chat: int) -> int:
+        if self.size == 1:
+            return 0
+        if (shard := self._cache.get(chat)) is None:
+            index = bisect.bisect(self._hashes, _ring_hash(str(chat))) % len(self._hashes)
+            shard = self._cache[chat] = self._shards[index]
+        return shard
+
+
+class Publisher:
+    """
+    Publishes to the bus what is queued during one loop iteration, or every
+    `batch` items, in one redis pipeline per shard instead of a round trip each.
+    publish returns a future which is done once the item is sent, a pipeline
+    that fails is tried `retries` more times before the futures get the error.
+    """
+
+    batch = int(os.getenv("VCC_PUBLISH_BATCH", 100))
+    retries = int(os.getenv("VCC_PUBLISH_RETRIES", 2))
+
+    def __init__(self, redis: Any | list[Any], ring: HashRing | None = None):
+        # Clients of the shards, chats are spread across them by ring
+        self.shards: list[Any] = list(redis) if isinstance(redis, list) else [redis]
+        self.ring = HashRing(len(self.shards)) if ring is None else ring
+        self._buffer: list[tuple[Literal["messages", "events"], int, bytes, asyncio.Future]] = []
+        self._tasks: set[asyncio.Task] = set()
+        # Pipelines are sent one after another, so that the order of a chat is kept
+        self._lock = asyncio.Lock()
+
+    def publish(
+        self, kind: Literal["messages", "events"], chat: int, data: bytes
+    ) -> asyncio.Future[None]:
+        future = asyncio.get_running_loop().create_future()
+        self._buffer.append((kind, chat, data, future))
+        if len(self._buffer) >= self.batch:
+            self._flush()
+        elif len(self._buffer) == 1:
+            asyncio.get_running_loop().call_soon(self._flush)
+        return future
+
+    def _flush(self) -> None:
+        if not self._buffer:
+            return
+        buffer, self._buffer = self._buffer, []
+        task = asyncio.create_task(self._execute(buffer))
+        self._tasks.add(task)
+        task.add_done_callback(self._tasks.discard)
+
+    async def _execute_shard(
+        self,
+        shard: int,
+        buffer: list[tuple[Literal["messages", "events"], int, bytes, asyncio.Future]],
+    ) -> None:
+        for attempt in range(self.retries + 1):
+            try:
+                async with self.shards[shard].pipeline(transaction=False) as pipe:
+                    for kind, chat, data, _ in buffer:
+                        publish_bus(pipe, kind, chat, data)
+                    await pipe.execute()
+                break
+            except Exception as e:
+                log.warning(
+                    f"{len(buffer)} items couldn't be published on shard {shard}"
+                    f" (attempt {attempt + 1})",
+                    exc_info=True,
+                )
+                error = e
+                if attempt < self.retries:
+                    await asyncio.sleep(0.1 * 2**attempt)
+        else:
+            for *_, future in buffer:
+                if not future.done():
+                    future.set_exception(error)
+            return
+        for *_, future in buffer:
+            if not future.done():
+                future.set_result(None)
+
+    async def _execute(
+        self, buffer: list[tuple[Literal["messages", "events"], int, bytes, asyncio.Future]]
+    ) -> None:
+        by_shard: dict[
+            int, list[tuple[Literal["messages", "events"], int, bytes, asyncio.Future]]
+        ] = {}
+        for item in buffer:
+            by_shard.setdefault(self.ring.get(item[1]), []).append(item)
+        async with self._lock:
+            await asyncio.gather(
+                *(self._execute_shard(shard, items) for shard, items in by_shard.items())
+            )
+
+    async def flush(self) -> None:
+        """Wait until everything published so far was sent or given up on"""
+        self._flush()
+        await asyncio.gather(*self._tasks)
+
+
+def get_rpc_address() -> tuple[str, tuple]:
+    """
+    Transport name and address of the rpc server, from RPCHOST:
+    `host:port` for tcp or `unix:/path/to/socket`
+    """
+    if os.getenv("RPCHOST", "").startswith("unix:"):
+        return "unix", (os.environ["RPCHOST"][len("unix:"):],)
+    return "tcp", get_host()
+
 __all__ = [
     "check",
     "rpc_request",
     "get_host",
+    "get_rpc_address",
+    "get_channel",
+    "Codec",
+    "codecs",
+    "json_codec",
+    "get_codec",
+    "encode_bus",
+    "decode_bus",
+    "chat_channels",
+    "bus",
+    "get_stream",
+    "get_streams",
+    "publish_bus",
+    "get_redis_urls",
+    "HashRing",
+    "Publisher",
     "RpcException",
     "ChatAlreadyJoinedError",
     "ChatNotJoinedError",
@@ -199,6 +559,9 @@ __all__ = [
     "NotAuthorizedError",
     "PermissionDeniedError",
     "ProviderNotFoundError",
+    "DeadlineExceededError",
+    "OverloadedError",
+    "ClientOverflowError",
     "log",
     "ChatUserPermissionName",
     "ChatPermissionName",
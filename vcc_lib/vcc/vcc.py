@@ -10,7 +10,7 @@ import warnings
 import uuid
 import os
 
-from functools import wraps
+from functools import cached_property, wraps
 from redis.asyncio.client import PubSub
 from redis.backoff import ExponentialBackoff
 from redis.asyncio.retry import Retry
@@ -18,8 +18,10 @@ from redis.exceptions import ConnectionError, TimeoutError
 from typing import (
     TYPE_CHECKING,
     Any,
+    AsyncIterator,
     Awaitable,
     Callable,
+    Iterable,
     cast,
     Coroutine,
     Literal,
@@ -50,6 +52,8 @@ class RpcExchanger:
 
     _redis: redis.Redis[bytes]
     recv_hook: Callable[[RedisMessage], None | Awaitable[None]] | None = None
+    # Called with (type, data, chat) of every event received
+    event_hook: Callable[[str, Any, int], None | Awaitable[None]] | None = None
 
     def __init__(
         self,
@@ -58,73 +62,222 @@ class RpcExchanger:
         rpc_port: int | None = None,
         redis_url: str | None = None,
     ) -> None:
-        host_env = get_host()
-        rpc_host = host_env[0] if rpc_host is None else rpc_host
-        rpc_port = host_env[1] if rpc_port is None else rpc_port
-        self._redis_url = (
-            getenv("REDIS_URL", "redis://localhost:6379")
-            if redis_url is None
-            else redis_url
-        )
-
-        self._socket_address = (rpc_host, rpc_port)
-        self._redis = redis.Redis.from_url(
-            self._redis_url,
+        if rpc_host is None and rpc_port is None:
+            self._rpc_address = get_rpc_address()
+        else:
+            host_env = get_host()
+            rpc_host = host_env[0] if rpc_host is None else rpc_host
+            rpc_port = host_env[1] if rpc_port is None else rpc_port
+            self._rpc_address = ("tcp", (rpc_host, rpc_port))
+        # Several urls separated by commas shard the chats across redis instances
+        self._redis_urls = get_redis_urls(redis_url)
+        self._ring = HashRing(len(self._redis_urls))
+        self._shards: list[redis.Redis[bytes]] = [
+            self._connect(url) for url in self._redis_urls
+        ]
+        self._redis = self._shards[0]
+        self._pubsubs_raw: list[PubSub] = [
+            i.pubsub(ignore_subscribe_messages=True) for i in self._shards
+        ]
+        self.pubsubs: list[PubSub] = []
+        self._recv_tasks: list[asyncio.Task] = []
+        self._rpc_factory = RpcServiceFactory()
+        # Codec of what is published, see VCC_CODEC
+        self._codec = get_codec()
+        self._publisher = Publisher(self._shards, self._ring)
+        # (chat, user) -> (expiry, result of chat/check_send), see RpcExchangerBaseClient.check_send
+        self.permission_cache: dict[tuple[int, int], tuple[float, bool]] = {}
+        # Bumped by forget_permission, an answer asked for before that isn't cached
+        self.permission_generation = 0
+        self.client_list: set[RpcExchangerBaseClient] = set()
+        # Who gets the messages of a chat, kept up to date by the clients
+        self.chat_clients: dict[int, set[RpcExchangerBaseClient]] = {}
+        self.chat_robots: dict[int, set[RpcExchangerBaseClient]] = {}
+        self.session_clients: dict[tuple[int, str], set[RpcExchangerBaseClient]] = {}
+        # With VCC_CHAT_CHANNELS, chats whose channels are subscribed and by how many users
+        self.chat_refs: dict[int, int] = {}
+        self._subscribed_chats: set[int] = set()
+        self._dirty_chats: set[int] = set()
+        self._sync_task: asyncio.Task | None = None
+
+    @staticmethod
+    def _connect(url: str) -> redis.Redis[bytes]:
+        return redis.Redis.from_url(
+            url,
             retry=Retry(ExponentialBackoff(), 5),
             retry_on_error=[ConnectionError, TimeoutError],
             health_check_interval=15,
         )
-        self._pubsub_raw: PubSub = self._redis.pubsub(ignore_subscribe_messages=True)
-        self._rpc_factory = RpcServiceFactory()
-        self.client_list: set[RpcExchangerBaseClient] = set()
 
-    async def recv_task(self):
+    @staticmethod
+    def _index_add(index: dict, key: Any, client: RpcExchangerBaseClient) -> bool:
+        if (clients := index.get(key)) is None:
+            clients = index[key] = set()
+        if client in clients:
+            return False
+        clients.add(client)
+        return True
+
+    @staticmethod
+    def _index_discard(index: dict, key: Any, client: RpcExchangerBaseClient) -> bool:
+        if (clients := index.get(key)) is None or client not in clients:
+            return False
+        clients.remove(client)
+        if not clients:
+            del index[key]
+        return True
+
+    def acquire_chat(self, chat: int) -> None:
+        """Receive the messages of a chat until release_chat is called as many times"""
+        self.chat_refs[chat] = self.chat_refs.get(chat, 0) + 1
+        if self.chat_refs[chat] == 1:
+            self._sync_chat(chat)
+
+    def release_chat(self, chat: int) -> None:
+        if chat not in self.chat_refs:
+            return
+        self.chat_refs[chat] -= 1
+        if self.chat_refs[chat] == 0:
+            del self.chat_refs[chat]
+            self._sync_chat(chat)
+
+    def _sync_chat(self, chat: int) -> None:
+        if not chat_channels or bus == "streams":
+            return
+        self._dirty_chats.add(chat)
+        if self.pubsubs and (self._sync_task is None or self._sync_task.done()):
+            self._sync_task = asyncio.create_task(self._sync_chats())
+
+    async def _sync_chats(self) -> None:
+        # One task at a time, so a subscribe and the unsubscribe following it can't be reordered
+        while self._dirty_chats:
+            chat = self._dirty_chats.pop()
+            channels = (get_channel("messages", chat), get_channel("events", chat))
+            pubsub = self.pubsubs[self._ring.get(chat)]
+            try:
+                if chat in self.chat_refs and chat not in self._subscribed_chats:
+                    await pubsub.subscribe(*channels)
+                    self._subscribed_chats.add(chat)
+                elif chat not in self.chat_refs and chat in self._subscribed_chats:
+                    await pubsub.unsubscribe(*channels)
+                    self._subscribed_chats.discard(chat)
+            except Exception as e:
+                log.warning(e, exc_info=True)
+
+    async def _subscribe(self, shard: int) -> None:
+        """(Re)subscribe on a shard after connecting to it"""
+        pubsub = self.pubsubs[shard]
+        if not chat_channels:
+            await pubsub.subscribe("messages")
+            await pubsub.subscribe("events")
+            return
+        # Never published to, keeps listen() going while no chat is subscribed
+        await pubsub.subscribe("gateways")
+        chats = {chat for chat in self._subscribed_chats if self._ring.get(chat) == shard}
+        self._subscribed_chats -= chats
+        self._dirty_chats |= {chat for chat in self.chat_refs if self._ring.get(chat) == shard}
+        if self._sync_task is None or self._sync_task.done():
+            self._sync_task = asyncio.create_task(self._sync_chats())
+
+    def index_chats(
+        self,
+        client: RpcExchangerBaseClient,
+        joined: Iterable[int] = (),
+        quitted: Iterable[int] = (),
+    ) -> None:
+        robot = isinstance(client, RpcRobotExchangerClient)
+        for chat in joined:
+            if self._index_add(self.chat_clients, chat, client):
+                self.acquire_chat(chat)
+            if robot:
+                self._index_add(self.chat_robots, chat, client)
+        for chat in quitted:
+            if self._index_discard(self.chat_clients, chat, client):
+                self.release_chat(chat)
+            self._index_discard(self.chat_robots, chat, client)
+
+    def index_session(self, client: RpcExchangerBaseClient, chat: int, session: str) -> None:
+        self._index_add(self.session_clients, (chat, session), client)
+
+    def remove_client(self, client: RpcExchangerBaseClient) -> None:
+        self.client_list.discard(client)
+        self.index_chats(client, quitted=list(client._chat_list))
+        for key in client._session_list:
+            self._index_discard(self.session_clients, key, client)
+
+    def recipients(self, chat: int, session: str | None = None) -> Iterable[RpcExchangerBaseClient]:
+        if session is None:
+            return self.chat_clients.get(chat, ())
+        # Robots get the messages of every session
+        return {
+            client
+            for client in self.session_clients.get((chat, session), ())
+            if chat in client._chat_list
+        } | self.chat_robots.get(chat, set())
+
+    def queue_stats(self) -> dict[str, int]:
+        queues = [client._queue for client in self.client_list]
+        return {
+            "clients": len(queues),
+            "queued": sum(i.qsize() for i in queues),
+            "dropped": sum(i.dropped for i in queues),
+            "high_water": max((i.high_water for i in queues), default=0),
+            "overflowed": sum(i.overflowed for i in queues),
+        }
+
+    def forget_permission(self, chat: int, user: int) -> None:
+        self.permission_cache.pop((chat, user), None)
+        self.permission_generation += 1
+
+    async def dispatch(self, kind: bytes, raw: bytes) -> None:
+        """Hand a message or an event from the bus to the clients which get it"""
+        json_content_untyped: Any = decode_bus(raw)
+        if kind == b"messages":
+            json_message: RedisMessage = MessageEnvelope(raw, json_content_untyped)
+            if self.recv_hook is not None:
+                recv_hook_return = self.recv_hook(json_message)
+                if isinstance(recv_hook_return, Coroutine):
+                    asyncio.create_task(recv_hook_return)
+            session: str | None = json_message.get("session")
+            username = json_message["username"]
+            msg_type = json_message["msg_type"]
+            payload = json_message["payload"]
+            chat = int(json_message["chat"])
+            uid = int(json_message["uid"])
+            id = json_message["id"]
+            content = ("message", json_message)
+            for client in list(self.recipients(chat, session)):
+                if not client._queue.offer(content):
+                    await client._queue.put(content)
+            log.debug(f"{username=} {payload=} {chat=} {session=}")
+        elif kind == b"events":
+            json_content: RedisEvent = json_content_untyped
+            type = json_content["type"]
+            data = json_content["data"]
+            chat = int(json_content["chat"])
+            if type == "permission_changed":
+                self.forget_permission(chat, data["user_id"])
+            if self.event_hook is not None:
+                event_hook_return = self.event_hook(type, data, chat)
+                if isinstance(event_hook_return, Coroutine):
+                    asyncio.create_task(event_hook_return)
+            content = ("event", type, data, chat)
+            for client in list(self.recipients(chat)):
+                if not client._queue.offer(content):
+                    await client._queue.put(content)
+
+    async def recv_task(self, shard: int = 0):
         raw_message: Any = None
         try:
-            async for raw_message in self.pubsub.listen():
+            async for raw_message in self.pubsubs[shard].listen():
                 if raw_message is None:
                     await asyncio.sleep(0.01)
                     continue
                 log.debug(f"{raw_message['data']=} {raw_message['channel']=}")
                 try:
-                    json_content_untyped: Any = json.loads(raw_message["data"].decode())
-                    if raw_message["channel"] == b"messages":
-                        json_message: RedisMessage = json_content_untyped
-                        if self.recv_hook is not None:
-                            recv_hook_return = self.recv_hook(json_message)
-                            if isinstance(recv_hook_return, Coroutine):
-                                asyncio.create_task(recv_hook_return)
-                        session: str | None = None
-                        username = json_message["username"]
-                        msg_type= json_message["msg_type"]
-                        payload = json_message["payload"]
-                        chat = int(json_message["chat"])
-                        uid = int(json_message["uid"])
-                        if "session" in json_message:
-                            session = json_message["session"]
-                        id = json_message["id"]
-                        for client in self.client_list:
-                            if chat in client._chat_list and (
-                                session is None
-                                or isinstance(client, RpcRobotExchangerClient)
-                                or (chat, session) in client._session_list
-                            ):
-                                client._recv_future.set_result(("message",
-                                json_message)
-                                )
-                        if "session" in json_message:
-                            session = json_message["session"]
-                        log.debug(f"{username=} {payload=} {chat=} {session=}")
-                    elif raw_message["channel"] == b"events":
-                        json_content: RedisEvent = json_content_untyped
-                        type = json_content["type"]
-                        data = json_content["data"]
-                        chat = int(json_content["chat"])
-                        for client in self.client_list:
-                            if chat in client._chat_list:
-                                client._recv_future.set_result(
-                                    ("event", type, data, chat)
-                                )
+                    await self.dispatch(
+                        raw_message["channel"].split(b":", 1)[0], raw_message["data"]
+                    )
                 except asyncio.CancelledError:
                     return
                 except Exception as e:
@@ -132,36 +285,73 @@ class RpcExchanger:
                     raw_message = None
                     await asyncio.sleep(0.01)
         except (redis.TimeoutError, redis.ConnectionError):
-            self._redis = redis.Redis.from_url(
-                self._redis_url,
-                retry=Retry(ExponentialBackoff(), 5),
-                retry_on_error=[ConnectionError, TimeoutError],
-                health_check_interval=15,
-            )
-            self._pubsub_raw: PubSub = self._redis.pubsub(
+            self._shards[shard] = self._connect(self._redis_urls[shard])
+            self._publisher.shards[shard] = self._shards[shard]
+            self._pubsubs_raw[shard] = self._shards[shard].pubsub(
                 ignore_subscribe_messages=True
             )
-            self.pubsub: PubSub = await self._pubsub_raw.__aenter__()
-            await self.pubsub.subscribe("messages")
-            await self.pubsub.subscribe("events")
-            await self.recv_task()
+            self.pubsubs[shard] = await self._pubsubs_raw[shard].__aenter__()
+            if shard == 0:
+                self._redis = self._shards[0]
+                self.pubsub = self.pubsubs[0]
+            await self._subscribe(shard)
+            await self.recv_task(shard)
+
+    async def stream_task(self, shard: int = 0):
+        """With VCC_BUS=streams, read the streams, resuming where the last read stopped"""
+        last: dict[str, bytes | str] = {}
+        while True:
+            try:
+                for key in get_streams("messages") + get_streams("events"):
+                    if key not in last:
+                        entries = await self._shards[shard].xrevrange(key, count=1)
+                        last[key] = entries[0][0] if entries else "0-0"
+                result = await self._shards[shard].xread(last, count=100, block=1000)
+            except asyncio.CancelledError:
+                return
+            except (redis.TimeoutError, redis.ConnectionError) as e:
+                log.warning(e, exc_info=True)
+                await asyncio.sleep(1)
+                continue
+            for key, entries in result or []:
+                key = key.decode() if isinstance(key, bytes) else key
+                kind = key.split(":")[1].encode()
+                for id, fields in entries:
+                    last[key] = id
+                    try:
+                        await self.dispatch(kind, fields[b"data"])
+                    except asyncio.CancelledError:
+                        return
+                    except Exception as e:
+                        log.debug(e, exc_info=True)
 
     async def __aenter__(self) -> RpcExchanger:
-        asyncio.create_task(self._rpc_factory.aconnect())
-
-        self.pubsub: PubSub = await self._pubsub_raw.__aenter__()
-        await self.pubsub.subscribe("messages")
-        await self.pubsub.subscribe("events")
-
-        self._recv_task = asyncio.create_task(self.recv_task())
+        asyncio.create_task(self._rpc_factory.aconnect(self._rpc_address[1], self._rpc_address[0]))
+
+        self.pubsubs = [await i.__aenter__() for i in self._pubsubs_raw]
+        self.pubsub: PubSub = self.pubsubs[0]
+        if bus == "streams":
+            self._recv_tasks = [
+                asyncio.create_task(self.stream_task(i)) for i in range(len(self._shards))
+            ]
+            return self
+        for i in range(len(self._shards)):
+            await self._subscribe(i)
+
+        self._recv_tasks = [
+            asyncio.create_task(self.recv_task(i)) for i in range(len(self._shards))
+        ]
         return self
 
     async def __aexit__(self, *args: Any) -> None:
-        self._recv_task.cancel()
-        await self.pubsub.unsubscribe("messages")
-        await self.pubsub.unsubscribe("events")
-        await self._pubsub_raw.__aexit__(*args)
-        await self._redis.close()
+        for task in self._recv_tasks:
+            task.cancel()
+        for pubsub, pubsub_raw in zip(self.pubsubs, self._pubsubs_raw):
+            await pubsub.unsubscribe()
+            await pubsub_raw.__aexit__(*args)
+        await self._publisher.flush()
+        for shard in self._shards:
+            await shard.close()
 
     async def send_msg(
         self, uid: int, username: str, msg: str, chat: int, session: str | None = None
@@ -170,9 +360,10 @@ class RpcExchanger:
     async def send(self,uid: int, username: str,chat:int,payload: Any,session: str|None=None,msg_type:str="msg"):
         log.debug(f"messages")
         id = str(uuid.uuid4())
-        await self._redis.publish(
-            f"messages",
-            json.dumps(
+        await self._publisher.publish(
+            "messages",
+            chat,
+            encode_bus(
                 {
                     "id":id,
                     "uid": uid,
@@ -182,7 +373,8 @@ class RpcExchanger:
                     "chat": chat,
                     "time": int(time.time() * 1000),
                     **({} if session is None else {"session": session}),
-                }
+                },
+                self._codec,
             ),
         )
         log.debug(f"{username=} {chat=}")
@@ -191,31 +383,35 @@ class RpcExchanger:
         self, type: str, data: Any, chat: int, session: str | None = None
     ) -> None:
         log.debug(f"event")
-        await self._redis.publish(
-            f"events",
-            json.dumps(
+        await self._publisher.publish(
+            "events",
+            chat,
+            encode_bus(
                 {
                     "type": type,
                     "data": data,
                     "chat": chat,
                     **({} if session is None else {"session": session}),
-                }
+                },
+                self._codec,
             ),
         )
         log.debug(f"{type=} {chat=}")
 
     async def rpc_request(
-        self, namespace: str, service: str, data: dict[str, Any]
+        self, namespace: str, service: str, data: dict[str, Any], timeout: float | None = None
     ) -> Any:
         log.debug(f"{service=} {data=}")
-        result = await cast(Transport, self._rpc_factory.superservice).call(
-            namespace, service, data
-        )
+        result = await self._rpc_factory.call(namespace, service, data, timeout)
         log.debug(f"{result=}")
         return result
 
-    def get_redis_instance(self) -> redis.Redis[bytes]:
-        return self._redis
+    def get_redis_instance(self, chat: int | None = None) -> redis.Redis[bytes]:
+        """The shard which holds chat, or the first one"""
+        return self._redis if chat is None else self._shards[self._ring.get(chat)]
+
+    def get_redis_instances(self) -> list[redis.Redis[bytes]]:
+        return list(self._shards)
 
     def create_client(self) -> RpcExchangerClient:
         return RpcExchangerClient(self)
@@ -224,14 +420,110 @@ class RpcExchanger:
         return RpcRobotExchangerClient(self)
 
 
+class MessageEnvelope(dict):
+    """
+    A message from redis, shared by all its recipients in this process.
+    The encodings gateways send are computed the first time they are needed,
+    so a message is encoded once whatever the number of recipients.
+    """
+
+    def __init__(self, raw: bytes, message: RedisMessage) -> None:
+        super().__init__(message)
+        # The message as published to redis, see tools.encode_bus
+        self.raw = raw
+
+    def _readonly(self, *args: Any, **kwargs: Any) -> None:
+        raise TypeError("MessageEnvelope is shared by every recipient, copy it instead")
+
+    __setitem__ = __delitem__ = update = pop = popitem = setdefault = clear = _readonly  # type: ignore
+
+    @cached_property
+    def jsonrpc(self) -> str:
+        """JSON-RPC notification of web-vcc"""
+        if self.raw[:1] == b"{":
+            # Already json, no need to encode it again
+            return '{"method": "message", "params": ' + self.raw.decode() + ', "jsonrpc": "2.0"}'
+        return json_codec.dumps({"method": "message", "params": self, "jsonrpc": "2.0"}).decode()
+
+    @cached_property
+    def bot_frame(self) -> str:
+        """Frame of vcc-bot"""
+        return json_codec.dumps(
+            {
+                "type": "message",
+                "ok": True,
+                "id": self["id"],
+                "response": {
+                    "uid": self["uid"],
+                    "username": self["username"],
+                    "msg": self["payload"],
+                    "chat": self["chat"],
+                    "session": self.get("session"),
+                },
+            }
+        ).decode()
+
+
+class ClientQueue(asyncio.Queue):
+    """
+    What a client has received but not read yet, at most maxsize items.
+    When it is full, overflow decides what happens to a new item:
+    "drop_oldest" drops the oldest one, "disconnect" drops everything and
+    makes the next get raise ClientOverflowError, "block" makes put wait.
+    """
+
+    def __init__(self, maxsize: int = 0, overflow: str = "drop_oldest") -> None:
+        super().__init__(maxsize)
+        self.overflow = overflow
+        self.overflowed = False
+        self.dropped = 0
+        self.high_water = 0
+
+    def offer(self, item: Any) -> bool:
+        """Queue item without waiting, False if it has to be put with put instead"""
+        if self.overflowed:
+            self.dropped += 1
+            return True
+        if self.full():
+            match self.overflow:
+                case "block":
+                    return False
+                case "disconnect":
+                    self.overflowed = True
+                    self.dropped += self.qsize() + 1
+                    while not self.empty():
+                        self.get_nowait()
+                    return True
+                case _:
+                    self.get_nowait()
+                    self.dropped += 1
+        self.put_nowait(item)
+        return True
+
+    def _put(self, item: Any) -> None:
+        super()._put(item)
+        self.high_water = max(self.high_water, self.qsize())
+
+    async def get(self) -> Any:
+        if self.overflowed:
+            raise ClientOverflowError()
+        return await super().get()
+
+
 class RpcExchangerBaseClient:
+    # Size and overflow policy of the receive queue of every client, see ClientQueue
+    queue_size = int(getenv("VCC_CLIENT_QUEUE_SIZE", 1000))
+    queue_overflow = getenv("VCC_CLIENT_QUEUE_OVERFLOW", "drop_oldest")
+    # Seconds a chat/check_send result is trusted without a permission_changed event
+    permission_ttl = float(getenv("VCC_PERMISSION_TTL", 60))
+
     _exchanger: RpcExchanger
     _chat_list: set[int]
     _session_list: set[tuple[int, str]]
     _id: int | None
     _name: str | None
     _pubsub: PubSub
-    _recv_future: asyncio.Future
+    _queue: ClientQueue
     _chat_list_inited: bool
 
 
@@ -253,7 +545,7 @@ class RpcExchangerBaseClient:
         self._chat_list_lock = asyncio.Lock()
         self._pubsub = self._exchanger.pubsub
         self._exchanger.client_list.add(self)
-        self._recv_future = asyncio.Future()
+        self._queue = ClientQueue(self.queue_size, self.queue_overflow)
         self._chat_list_inited = False
 
     @check()
@@ -264,6 +556,57 @@ class RpcExchangerBaseClient:
     async def chat_list(self) -> list[ChatInfo]:
         ...
 
+    def _add_chat(self, chat: int) -> None:
+        self._chat_list.add(chat)
+        self._exchanger.index_chats(self, joined=(chat,))
+        # Denied while not in the chat
+        self._exchanger.forget_permission(chat, cast(int, self._id))
+
+    def _discard_chat(self, chat: int) -> None:
+        self._chat_list.discard(chat)
+        self._exchanger.index_chats(self, quitted=(chat,))
+
+    def _set_chat_list(self, chats: set[int]) -> None:
+        old = self._chat_list
+        self._chat_list = chats
+        self._exchanger.index_chats(self, chats - old, old - chats)
+
+    async def check_send(self, chat: int) -> None:
+        """Raise PermissionDeniedError if the user can't send in chat, cached for permission_ttl"""
+        key = (chat, cast(int, self._id))
+        cache = self._exchanger.permission_cache
+        if (cached := cache.get(key)) is None or cached[0] < time.monotonic():
+            generation = self._exchanger.permission_generation
+            allowed = bool(await self._rpc.chat.check_send(chat_id=chat, user_id=self._id))
+            cached = (time.monotonic() + self.permission_ttl, allowed)
+            # A permission_changed came while asking, the answer may be out of date already
+            if generation == self._exchanger.permission_generation:
+                cache[key] = cached
+        if not cached[1]:
+            raise PermissionDeniedError()
+
+    @check()
+    async def check_send_many(self, chats: list[int]) -> list[bool]:
+        """Whether the user can send in each chat, what isn't cached is asked in one request"""
+        cache = self._exchanger.permission_cache
+        now = time.monotonic()
+        allowed: dict[int, bool] = {}
+        for chat in chats:
+            if (cached := cache.get((chat, cast(int, self._id)))) is not None and cached[0] >= now:
+                allowed[chat] = cached[1]
+        missing = [chat for chat in dict.fromkeys(chats) if chat not in allowed]
+        if missing:
+            generation = self._exchanger.permission_generation
+            results = await self._rpc.chat.check_send_many(
+                pairs=[(chat, self._id) for chat in missing]
+            )
+            expiry = time.monotonic() + self.permission_ttl
+            for chat, result in zip(missing, results):
+                allowed[chat] = bool(result)
+                if generation == self._exchanger.permission_generation:
+                    cache[chat, cast(int, self._id)] = (expiry, allowed[chat])
+        return [allowed[chat] for chat in chats]
+
     def check_authorized(self) -> None:
         if self._id is None or self._name is None:
             raise NotAuthorizedError()
@@ -297,20 +640,19 @@ class RpcExchangerBaseClient:
     ) -> tuple[Literal["message"],dict] | tuple[
         Literal["event"], Event, Any, int
     ]:
-        content = await self._recv_future
+        content = await self._queue.get()
         if content[0] == "event":
             data = content[2]
             chat = content[3]
             match content[1]:
                 case "join" if data["user_id"] == self._id:
-                    self._chat_list.add(chat)
+                    self._add_chat(chat)
                 case "quit" if data["user_id"] == self._id:
-                    self._chat_list.discard(chat)
+                    self._discard_chat(chat)
                 case "kick" if data["kicked_user_id"] == self._id:
-                    self._chat_list.discard(chat)
+                    self._discard_chat(chat)
                 case "invite" if data["invited_user_id"] == self._id:
-                    self._chat_list.add(chat)
-        self._recv_future = asyncio.Future()
+                    self._add_chat(chat)
         return content
 
     @check()
@@ -319,6 +661,23 @@ class RpcExchangerBaseClient:
         """Get name of chat by id"""
         ...
 
+    @check()
+    @rpc_request("chat/get_names")
+    async def chat_get_names(self, ids: list[int]) -> list[str | None]:
+        """Names of chats in one request, None for the ones which don't exist"""
+        ...
+
+    @check()
+    async def chat_get_users_many(self, ids: list[int]) -> list[list[tuple[int, str]]]:
+        """chat_get_users of several chats in one request, [] for the ones not joined"""
+        if not self._chat_list_inited:
+            await self.chat_list()
+        joined = [id for id in ids if id in self._chat_list]
+        users = dict(
+            zip(joined, await self._rpc.chat.get_users_many(chat_ids=joined) if joined else [])
+        )
+        return [[tuple(i) for i in users.get(id, [])] for id in ids]  # type: ignore
+
     @check(joined="id", error_return=[])
     async def chat_get_users(self, id: int) -> list[tuple[int, str]]:
         """Get id of all users in the chat"""
@@ -382,10 +741,28 @@ class RpcExchangerBaseClient:
     ) -> tuple[str, str]:
         ...
     
+    @check(joined="chatid")
+    async def record_query_pages(
+        self, chatid: int, time: int
+    ) -> AsyncIterator[list[MessageRecord]]:
+        """Pages of the records, as the record service streams them"""
+        result = await self._exchanger.rpc_request(
+            "record", "query_record", {"chatid": chatid, "time": time}
+        )
+        if isinstance(result, list):
+            # Sent in one response: the pages by a peer without framing,
+            # or the records by a record service which doesn't stream
+            async def pages():
+                for page in result if result and isinstance(result[0], list) else [result]:
+                    if page:
+                        yield page
+
+            return pages()
+        return result
+
     @check(joined="chatid", error_return=[])
-    @rpc_request("record/query_record")
     async def record_query(self, chatid: int, time: int) -> list[MessageRecord]:
-        ...
+        return [i async for page in await self.record_query_pages(chatid, time) for i in page]
 
     def __aiter__(self) -> RpcExchangerBaseClient:
         return self
@@ -401,7 +778,7 @@ class RpcExchangerBaseClient:
         return self
 
     async def __aexit__(self, *args: Any) -> None:
-        self._exchanger.client_list.discard(self)
+        self._exchanger.remove_client(self)
         return None
 
 
@@ -489,8 +866,7 @@ class RpcExchangerClient(RpcExchangerBaseClient):
     async def send_msg(self, msg: str, chat: int, session: str | None) -> str:
         if session is not None and (chat, session) not in self._session_list:
             raise ChatNotJoinedError()
-        if not await self._rpc.chat.check_send(chat_id=chat, user_id=self._id):
-            raise PermissionDeniedError()
+        await self.check_send(chat)
         return await self._exchanger.send_msg(
             cast(int, self._id), cast(str, self._name), msg, chat, session
         )
@@ -498,8 +874,7 @@ class RpcExchangerClient(RpcExchangerBaseClient):
     async def send(self,chat:int,payload,session: str|None=None,msg_type:str="msg"):
         if session is not None and (chat, session) not in self._session_list:
             raise ChatNotJoinedError()
-        if not await self._rpc.chat.check_send(chat_id=chat, user_id=self._id):
-            raise PermissionDeniedError()
+        await self.check_send(chat)
         return await self._exchanger.send(
             cast(int, self._id), cast(str, self._name),chat, payload, session
         )
@@ -512,8 +887,7 @@ class RpcExchangerClient(RpcExchangerBaseClient):
         await self.check_joined(chat)
         if session is not None and (chat, session) not in self._session_list:
             raise ChatNotJoinedError()
-        if not await self._rpc.chat.check_send(chat_id=chat, user_id=self._id):
-            raise PermissionDeniedError()
+        await self.check_send(chat)
         await self._exchanger.send_event(
             "typing", {"status": status, "uid": self.id}, chat, session
         )
@@ -538,6 +912,7 @@ class RpcExchangerClient(RpcExchangerBaseClient):
         )
         if result:
             self._session_list.add((chat_id, name))
+            self._exchanger.index_session(self, chat_id, name)
         return cast(bool, result)
 
     @check()
@@ -558,7 +933,7 @@ class RpcExchangerClient(RpcExchangerBaseClient):
         if not await self._rpc.chat.join(chat_id=id, user_id=self._id):
             return False
         async with self._chat_list_lock:
-            self._chat_list.add(id)
+            self._add_chat(id)
         return True
 
     @check(joined="id", error_return=False)
@@ -567,7 +942,7 @@ class RpcExchangerClient(RpcExchangerBaseClient):
         if not await self._rpc.chat.quit(chat_id=id, user_id=self._id):
             return False
         async with self._chat_list_lock:
-            self._chat_list.discard(id)
+            self._discard_chat(id)
         return True
 
     @check()
@@ -577,7 +952,7 @@ class RpcExchangerClient(RpcExchangerBaseClient):
         result_set = {i["id"] for i in result}
         self._chat_list_inited = True
         async with self._chat_list_lock:
-            self._chat_list = result_set
+            self._set_chat_list(result_set)
         return result
 
     @check(joined="chat_id", error_return=False)
@@ -632,6 +1007,12 @@ class RpcExchangerClient(RpcExchangerBaseClient):
     async def chat_get_nickname(self, chat_id: int, user_id: int) -> str:
         ...
 
+    @check(joined="chat_id")
+    @rpc_request()
+    async def chat_get_nicknames(self, chat_id: int, user_ids: list[int]) -> list[str | None]:
+        """chat_get_nickname of several users in one request"""
+        ...
+
     @check()
     @rpc_request("login/change_nickname", id_arg="id")
     async def change_nickname(self, nickname: str) -> None:
@@ -673,7 +1054,7 @@ class RpcExchangerClient(RpcExchangerBaseClient):
         ...
 
     async def __aexit__(self, *args: Any) -> None:
-        self._exchanger.client_list.discard(self)
+        self._exchanger.remove_client(self)
         if self._id is not None:
             await self._rpc.login.add_offline(id=self._id)
         return None
@@ -716,7 +1097,7 @@ class RpcRobotExchangerClient(RpcExchangerBaseClient):
         if not await self._rpc.bot.join(chat_id=id, bot_id=self._id):
             return False
         async with self._chat_list_lock:
-            self._chat_list.add(id)
+            self._add_chat(id)
         return True
 
     @check(joined="id", error_return=False)
@@ -725,7 +1106,7 @@ class RpcRobotExchangerClient(RpcExchangerBaseClient):
         if not await self._rpc.bot.quit(chat_id=id, bot_id=self._id):
             return False
         async with self._chat_list_lock:
-            self._chat_list.discard(id)
+            self._discard_chat(id)
         return True
 
     @check()
@@ -737,7 +1118,7 @@ class RpcRobotExchangerClient(RpcExchangerBaseClient):
         result_set = {i[0] for i in result}
         self._chat_list_inited = True
         async with self._chat_list_lock:
-            self._chat_list = result_set
+            self._set_chat_list(result_set)
         return result
 
     @check(joined="chat_id", error_return=False)
@@ -2,7 +2,10 @@
 from models import *
 from base import RpcServiceFactory
 from chat import all_user_permissions, all_chat_permissions
+from vcc.tools import HashRing, encode_bus, get_redis_urls, publish_bus
+import redis
 import traceback
+from typing import Any
 
 db = get_database()
 
@@ -14,6 +17,20 @@ bind_model(ChatBot, db)
 
 
 class Main:
+    def __init__(self):
+        # Methods run in threads, so a blocking client per shard is enough
+        self._shards = [redis.Redis.from_url(url) for url in get_redis_urls()]
+        self._ring = HashRing(len(self._shards))
+
+    def _send_event(self, chat: int, type: str, data: Any) -> None:
+        # Only after the transaction is committed, or clients may cache what is being changed
+        publish_bus(
+            self._shards[self._ring.get(chat)],
+            "events",
+            chat,
+            encode_bus({"type": type, "data": data, "chat": chat}),
+        )
+
     @db.atomic()
     def login(self, name: str, token: str) -> int | None:
         bot = Bot.get_or_none(name=name, token=token)
@@ -35,22 +52,23 @@ class Main:
             ChatBot.get(chat=chat, bot=bot),
         )
 
-    def _get_chat_bot_or_parent(
-        self, chat_id: int, bot_id: int
-    ) -> tuple[Chat, Bot, ChatBot, bool]:
-        chat = Chat.get_by_id(chat_id)
-        bot = Bot.get_by_id(bot_id)
-        try:
-            chat_bot = ChatBot.get(chat=chat, bot=bot)
-        except:
-            if (parent_chat := chat.parent) is None:
-                raise
-            if (
-                parent_chat_bot := ChatBot.get_or_none(chat=parent_chat, bot=bot)
-            ) is None:
-                raise
-            return chat, bot, parent_chat_bot
-        return chat, bot, chat_bot
+    def _get_chat_bot_or_parent(self, chat_id: int, bot_id: int) -> tuple[Chat, ChatBot]:
+        # Bots have no permission bits, being in the chat or its parent is enough.
+        # One query, the ChatBot of the chat itself comes first
+        chat = (
+            Chat.select(Chat, ChatBot)
+            .join(
+                ChatBot,
+                on=(ChatBot.chat == Chat.id) | (ChatBot.chat == Chat.parent),
+                attr="chat_bot",
+            )
+            .where(Chat.id == chat_id, ChatBot.bot == bot_id)
+            .order_by((ChatBot.chat == Chat.id).desc())
+            .first()
+        )
+        if chat is None:
+            raise ChatBot.DoesNotExist()
+        return chat, chat.chat_bot
 
     @db.atomic()
     def join(self, bot_id: int, chat_id: int) -> bool:
@@ -71,26 +89,34 @@ class Main:
         except:
             return False
 
-    @db.atomic()
     def kick(self, bot_id: int, kicked_user_id: int, chat_id: int) -> bool:
         try:
-            chat = self._get_chat_bot_or_parent(chat_id, bot_id)[0]
-            kicked_user = User.get(id=kicked_user_id)
-            kicked_chat_user = ChatUser.get(chat=chat, user=kicked_user)
-            kicked_chat_user.delete_instance()
-            return True
+            with db.atomic():
+                chat = self._get_chat_bot_or_parent(chat_id, bot_id)[0]
+                kicked_user = User.get(id=kicked_user_id)
+                kicked_chat_user = ChatUser.get(chat=chat, user=kicked_user)
+                kicked_chat_user.delete_instance()
         except:
             return False
+        self._send_event(
+            chat_id,
+            "kick",
+            {"kicked_user_name": kicked_user.name, "kicked_user_id": kicked_user_id},
+        )
+        self._send_event(chat_id, "permission_changed", {"user_id": kicked_user_id})
+        return True
 
-    @db.atomic()
     def rename(self, bot_id: int, new_name: str, chat_id: int) -> bool:
         try:
-            chat = self._get_chat_bot_or_parent(chat_id, bot_id)[0]
-            chat.name = new_name
-            chat.save()
-            return True
+            with db.atomic():
+                chat = self._get_chat_bot_or_parent(chat_id, bot_id)[0]
+                old_name = chat.name
+                chat.name = new_name
+                chat.save()
         except:
             return False
+        self._send_event(chat_id, "rename", {"old_name": old_name, "new_name": new_name})
+        return True
 
     @db.atomic()
     def check_send(self, bot_id: int, chat_id: int) -> bool:
@@ -103,26 +129,35 @@ class Main:
     def check_create_session(self, bot_id: int, chat_id: int) -> bool:
         return self.check_send(bot_id, chat_id)
 
-    @db.atomic()
     def modify_user_permission(
         self, chat_id: int, bot_id: int, modified_user_id: int, name: str, value: bool
     ) -> bool:
+        if name not in all_user_permissions:
+            return False
         try:
-            chat = self._get_chat_bot_or_parent(chat_id, bot_id)[0]
-            modified_user = User.get_by_id(modified_user_id)
-            modified_chat_user = ChatUser.get(chat=chat, user=modified_user)
-            if name not in all_user_permissions:
-                return False
-            # Maybe dangerous
-            setattr(modified_chat_user, name, value)
-            modified_chat_user.save()
-            if name == "banned" and value:
-                ChatUser.update(permissions=ChatUser.banned.set()).where(
-                    ChatUser.chat.parent == chat & ChatUser.user == modified_user
-                ).execute()
-            return True
+            with db.atomic():
+                chat = self._get_chat_bot_or_parent(chat_id, bot_id)[0]
+                modified_user = User.get_by_id(modified_user_id)
+                modified_chat_user = ChatUser.get(chat=chat, user=modified_user)
+                # Maybe dangerous
+                setattr(modified_chat_user, name, value)
+                modified_chat_user.save()
+                sub_chats = []
+                if name == "banned" and value:
+                    # Banned in the sub chats too
+                    sub_chats = [
+                        chat for chat, in Chat.select(Chat.id).where(Chat.parent == chat_id).tuples()
+                    ]
+                    if sub_chats:
+                        ChatUser.update(permissions=ChatUser.banned.set()).where(
+                            ChatUser.chat.in_(sub_chats), ChatUser.user == modified_user_id
+                        ).execute()
         except:
             return False
+        # Clients cache what they are allowed to do
+        for chat in [*sub_chats, chat_id]:
+            self._send_event(chat, "permission_changed", {"user_id": modified_user_id})
+        return True
 
     @db.atomic()
     def modify_permission(
@@ -164,5 +199,5 @@ class Main:
 if __name__ == "__main__":
     db.create_tables([User, Chat, ChatUser, Bot, ChatBot])
     server = RpcServiceFactory()
-    server.register(Main(), "bot")
+    server.register(Main(), "bot", threads=4)
     server.connect()
@@ -1,15 +1,27 @@
 #!/usr/bin/env python
 # type: ignore
 from __future__ import annotations
-import json
+import asyncio
 import os
+import time
+import uuid
 
+from collections import OrderedDict
 from peewee import *
-from typing import Any, Literal
+from typing import Any, Literal, NamedTuple
 
 import base
 import warnings
 import redis.asyncio as redis
+from vcc.tools import (
+    Publisher,
+    bus,
+    chat_channels,
+    decode_bus,
+    encode_bus,
+    get_redis_urls,
+    get_streams,
+)
 from models import *
 import traceback
 db = get_database()
@@ -21,7 +33,7 @@ bind_model(ChatUser, db)
 SYSTEM_UID = -1
 SYSTEM_USER_NAME = "system"
 
-EventType = Literal["join", "quit", "kick", "rename", "invite"]
+EventType = Literal["join", "quit", "kick", "rename", "invite", "permission_changed"]
 
 all_user_permissions = [
     "kick",
@@ -37,16 +49,201 @@ all_user_permissions = [
 all_chat_permissions = ["public"]
 
 
+# Bit of every permission in ChatUser.permissions
+permission_bits = {name: permission_bit(name) for name in all_user_permissions}
+
+_missing = object()
+
+
+class ChatMeta(NamedTuple):
+    name: str
+    parent: int | None
+    public: bool
+
+
+class LRUCache:
+    """
+    At most `size` entries which expire after `ttl` seconds. bot.py and other
+    chat services change the database too, ChatService drops entries on their
+    events but what has none (public, nicknames) is trusted for ttl.
+    Only touched from the event loop.
+    """
+
+    def __init__(self, size: int, ttl: float):
+        self.size = size
+        self.ttl = ttl
+        self.hits = 0
+        self.misses = 0
+        # Bumped by every write, a fill with an older version would bring back stale data
+        self.version = 0
+        self._data: OrderedDict[Any, tuple[float, Any]] = OrderedDict()
+
+    def get(self, key: Any) -> Any:
+        """The value, or _missing"""
+        entry = self._data.get(key)
+        if entry is None or entry[0] < time.monotonic():
+            self.misses += 1
+            return _missing
+        self._data.move_to_end(key)
+        self.hits += 1
+        return entry[1]
+
+    def _store(self, key: Any, value: Any) -> None:
+        self._data[key] = (time.monotonic() + self.ttl, value)
+        self._data.move_to_end(key)
+        if len(self._data) > self.size:
+            self._data.popitem(last=False)
+
+    def fill(self, key: Any, value: Any, version: int) -> None:
+        """Store what was read from the database when version was current"""
+        if version == self.version:
+            self._store(key, value)
+
+    def set(self, key: Any, value: Any) -> None:
+        self.version += 1
+        self._store(key, value)
+
+    def update(self, key: Any, func) -> None:
+        """Replace a cached value by func(value), if there is one"""
+        self.version += 1
+        if (entry := self._data.get(key)) is not None:
+            self._data[key] = (entry[0], func(entry[1]))
+
+    def pop(self, key: Any) -> None:
+        self.version += 1
+        self._data.pop(key, None)
+
+    def clear(self) -> None:
+        self.version += 1
+        self._data.clear()
+
+    def snapshot(self) -> dict[str, int]:
+        return {
+            "size": len(self._data),
+            "hits": self.hits,
+            "misses": self.misses,
+        }
+
+
 class ChatService:
     def __init__(self):
-        self._redis: redis.Redis[bytes] = redis.Redis.from_url(
-            os.environ.get("REDIS_URL", "redis://localhost")
+        # One client per shard, see get_redis_urls
+        self._shards: list[redis.Redis[bytes]] = [
+            redis.Redis.from_url(url)
+            for url in get_redis_urls(os.environ.get("REDIS_URL", "redis://localhost"))
+        ]
+        # A message and its event, like in kick, go out in one pipeline when gathered
+        self._publisher = Publisher(self._shards)
+        # Queries run there instead of blocking the event loop
+        self._db = DatabaseExecutor(db)
+        # (chat, user) -> (permissions, nickname) of members, and chat -> ChatMeta
+        # Kept up to date by the methods here which change them
+        cache_size = int(os.getenv("CHAT_CACHE_SIZE", 100000))
+        cache_ttl = float(os.getenv("CHAT_CACHE_TTL", 30))
+        self._members = LRUCache(cache_size, cache_ttl)
+        self._chats = LRUCache(cache_size, cache_ttl)
+        # Put in the events published here, the caches are already up to date with them
+        self._origin = uuid.uuid4().hex
+
+    async def _ainit(self) -> None:
+        # Every shard holds the events of some chats
+        for shard in range(len(self._shards)):
+            if bus == "streams":
+                asyncio.get_event_loop().create_task(self._event_stream_worker(shard))
+            else:
+                asyncio.get_event_loop().create_task(self._event_worker(shard))
+
+    def _forget_changed(self, event: dict[str, Any]) -> None:
+        """Drop what an event says was changed, maybe by bot.py or another chat service"""
+        if event.get("origin") == self._origin:
+            return
+        type, data, chat = event["type"], event["data"], int(event["chat"])
+        if type in ("permission_changed", "quit"):
+            self._members.pop((chat, data["user_id"]))
+        elif type == "kick":
+            self._members.pop((chat, data["kicked_user_id"]))
+        elif type == "rename":
+            self._chats.pop(chat)
+
+    async def _event_worker(self, shard: int) -> None:
+        while True:
+            pubsub = self._shards[shard].pubsub(ignore_subscribe_messages=True)
+            try:
+                if chat_channels:
+                    await pubsub.psubscribe("events:*")
+                else:
+                    await pubsub.subscribe("events")
+                async for raw_message in pubsub.listen():
+                    if raw_message["type"] in ("message", "pmessage"):
+                        self._forget_changed(decode_bus(raw_message["data"]))
+            except (redis.TimeoutError, redis.ConnectionError):
+                traceback.print_exc()
+            finally:
+                await pubsub.reset()
+            # What changed while disconnected is unknown
+            self._members.clear()
+            self._chats.clear()
+            await asyncio.sleep(1)
+
+    async def _event_stream_worker(self, shard: int) -> None:
+        last: dict[str, bytes | str] = {}
+        while True:
+            try:
+                for key in get_streams("events"):
+                    if key not in last:
+                        entries = await self._shards[shard].xrevrange(key, count=1)
+                        last[key] = entries[0][0] if entries else "0-0"
+                result = await self._shards[shard].xread(last, count=100, block=1000)
+            except (redis.TimeoutError, redis.ConnectionError):
+                # Streams keep what is published meanwhile, nothing is missed
+                await asyncio.sleep(1)
+                continue
+            for key, entries in result or []:
+                for id, fields in entries:
+                    last[key.decode()] = id
+                    self._forget_changed(decode_bus(fields[b"data"]))
+
+    async def _get_member(self, chat_id: int, user_id: int) -> tuple[int, str | None] | None:
+        """(permissions, nickname) of a user in a chat, None if not a member"""
+        key = (chat_id, user_id)
+        if (member := self._members.get(key)) is not _missing:
+            return member
+        version = self._members.version
+        member = await self._db.run(
+            lambda: ChatUser.select(ChatUser.permissions, ChatUser.nickname)
+            .where((ChatUser.chat == chat_id) & (ChatUser.user == user_id))
+            .tuples()
+            .first()
         )
+        # Users who aren't members are not cached, they may be added by another service
+        if member is not None:
+            self._members.fill(key, member, version)
+        return member
+
+    async def _get_chat(self, chat_id: int) -> ChatMeta | None:
+        if (chat := self._chats.get(chat_id)) is not _missing:
+            return chat
+        version = self._chats.version
+        row = await self._db.run(
+            lambda: Chat.select(Chat.name, Chat.parent, Chat.public)
+            .where(Chat.id == chat_id)
+            .tuples()
+            .first()
+        )
+        if row is None:
+            return None
+        chat = ChatMeta(*row)
+        self._chats.fill(chat_id, chat, version)
+        return chat
+
+    async def get_cache_stats(self) -> dict[str, dict[str, int]]:
+        return {"members": self._members.snapshot(), "chats": self._chats.snapshot()}
 
     async def _send_message(self, chat: int, msg: str) -> None:
-        await self._redis.publish(
-            f"messages",
-            json.dumps(
+        await self._publisher.publish(
+            "messages",
+            chat,
+            encode_bus(
                 {
                     "uid": SYSTEM_UID,
                     "username": SYSTEM_USER_NAME,
@@ -57,209 +254,336 @@ class ChatService:
         )
 
     async def _send_event(self, chat: int, type: EventType, data: Any) -> None:
-        await self._redis.publish(
-            f"events", json.dumps({"type": type, "data": data, "chat": chat})
+        await self._publisher.publish(
+            "events",
+            chat,
+            encode_bus({"type": type, "data": data, "chat": chat, "origin": self._origin}),
         )
 
     async def create_with_user(
         self, name: str, user_id: int, parent_chat_id: int
     ) -> int | None:
         # parent_chat_id is -1 if the chat has no parent
-        try:
-            if parent_chat_id == -1:
-                new_chat = Chat.create(name=name, parent=None)
-            else:
-                parent_chat = Chat.get_by_id(parent_chat_id)
-                if parent_chat.parent is not None:
-                    # Only 2 levels are allowed
-                    return None
-                # Make sure creator has already joined the parent chat
-                parent_chat_user = ChatUser.get(user=user_id, chat=parent_chat)
-                if not parent_chat_user.create_sub_chat or parent_chat_user.banned:
-                    return None
-                new_chat = Chat.create(name=name, parent=parent_chat)
+        def query() -> int | None:
+            # Make sure creator has already joined the parent chat, and isn't banned
+            if parent_chat_id != -1 and not (
+                effective_permissions(parent_chat_id, user_id) & permission_bits["create_sub_chat"]
+            ):
+                return None
+            new_chat = Chat.create(name=name, parent=None if parent_chat_id == -1 else parent_chat_id)
             ChatUser.create(
                 user=user_id,
                 chat=new_chat,
                 permissions=1 | 2 | 4 | 8 | 16 | 32 | 64 | 512,
             )
             return new_chat.id
+
+        try:
+            if parent_chat_id != -1:
+                parent_chat = await self._get_chat(parent_chat_id)
+                # Only 2 levels are allowed
+                if parent_chat is None or parent_chat.parent is not None:
+                    return None
+            return await self._db.run(query)
         except:
             return None
 
     async def get_name(self, id: int) -> str | None:
-        chat = Chat.get_or_none(id=id)
+        chat = await self._get_chat(id)
         if chat is None:
             return None
         return chat.name
 
     async def get_users(self, id: int) -> list[tuple[int, str]]:
         # Won't return users of sub-chats
-        chat_users = ChatUser.select().where(ChatUser.chat == id).execute()
-        user_names = [
-            (
-                chat_user.user.id,
-                chat_user.user.nickname
-                if chat_user.nickname is None
-                else chat_user.nickname,
+        # One query, the nickname in the chat wins over the one of the user
+        def query() -> list[tuple[int, str]]:
+            return list(
+                ChatUser.select(User.id, fn.COALESCE(ChatUser.nickname, User.nickname))
+                .join(User)
+                .where(ChatUser.chat == id)
+                .tuples()
+            )
+
+        return await self._db.run(query)
+
+    # The bulk versions below answer in the order of their arguments, one query at most
+
+    async def get_names(self, ids: list[int]) -> list[str | None]:
+        chats = {id: self._chats.get(id) for id in ids}
+        missing = [id for id, chat in chats.items() if chat is _missing]
+        if missing:
+            version = self._chats.version
+            rows = await self._db.run(
+                lambda: list(
+                    Chat.select(Chat.id, Chat.name, Chat.parent, Chat.public)
+                    .where(Chat.id.in_(missing))
+                    .tuples()
+                )
             )
-            for chat_user in chat_users
+            for id, *row in rows:
+                chats[id] = ChatMeta(*row)
+                self._chats.fill(id, chats[id], version)
+        return [
+            None if (chat := chats[id]) is _missing else chat.name for id in ids
+        ]
+
+    async def get_users_many(self, chat_ids: list[int]) -> list[list[tuple[int, str]]]:
+        rows = await self._db.run(
+            lambda: list(
+                ChatUser.select(
+                    ChatUser.chat, User.id, fn.COALESCE(ChatUser.nickname, User.nickname)
+                )
+                .join(User)
+                .where(ChatUser.chat.in_(chat_ids))
+                .tuples()
+            )
+        )
+        users: dict[int, list[tuple[int, str]]] = {}
+        for chat, user, nickname in rows:
+            users.setdefault(chat, []).append((user, nickname))
+        return [users.get(chat, []) for chat in chat_ids]
+
+    async def get_nicknames(self, chat_id: int, user_ids: list[int]) -> list[str | None]:
+        """Like get_nickname for every user"""
+        # The nickname in the chat, then the one of the user, then the name
+        rows = await self._db.run(
+            lambda: list(
+                User.select(
+                    User.id, fn.COALESCE(ChatUser.nickname, User.nickname, User.name)
+                )
+                .join(
+                    ChatUser,
+                    JOIN.LEFT_OUTER,
+                    on=(ChatUser.user == User.id) & (ChatUser.chat == chat_id),
+                )
+                .where(User.id.in_(user_ids))
+                .tuples()
+            )
+        )
+        nicknames: dict[int, str | None] = dict(rows)
+        nicknames[SYSTEM_UID] = SYSTEM_USER_NAME
+        return [nicknames.get(user) for user in user_ids]
+
+    async def check_send_many(self, pairs: list[tuple[int, int]]) -> list[bool]:
+        """check_send of every (chat_id, user_id)"""
+        pairs = [(chat, user) for chat, user in pairs]
+        members = {pair: self._members.get(pair) for pair in pairs}
+        missing = [pair for pair, member in members.items() if member is _missing]
+        if missing:
+            version = self._members.version
+            rows = await self._db.run(
+                lambda: list(
+                    ChatUser.select(
+                        ChatUser.chat, ChatUser.user, ChatUser.permissions, ChatUser.nickname
+                    )
+                    .where(Tuple(ChatUser.chat, ChatUser.user).in_(missing))
+                    .tuples()
+                )
+            )
+            for chat, user, *member in rows:
+                members[chat, user] = tuple(member)
+                self._members.fill((chat, user), members[chat, user], version)
+        send, banned = permission_bits["send"], permission_bits["banned"]
+        return [
+            (member := members[pair]) is not _missing
+            and bool(member[0] & send)
+            and not member[0] & banned
+            for pair in pairs
         ]
-        return user_names
 
     async def join(self, chat_id: int, user_id: int) -> bool:
-        try:
-            print(0)
+        def query() -> tuple[bool, list[tuple[int, ChatUser]]]:
             chat = Chat.get_by_id(chat_id)
             if not chat.public:
-                return False
+                return False, []
+            joined = []
             if chat.parent is not None:
                 parent_chat = chat.parent
                 if not parent_chat.public:
-                    return False
+                    return False, []
                 # Also join parent chat
                 parent_chat_user, parent_chat_user_created = ChatUser.get_or_create(
                     chat_id=parent_chat, user_id=user_id
                 )
+                joined.append((chat.parent_id, parent_chat_user))
                 if parent_chat_user.banned:
-                    return False
+                    return False, joined
             chat_user, chat_user_created = ChatUser.get_or_create(chat_id=chat, user_id=user_id)
+            joined.append((chat_id, chat_user))
             if chat_user.banned:
-                return False
+                return False, joined
+            return True, joined
+
+        try:
             # await self._send_message(chat_id, f"{user.name} has joined the chat.")
             # await self._send_event(
             #     chat_id, "join", {"user_name": user.name, "user_id": user_id}
             # )
-            print(1)
-            return True
+            result, joined = await self._db.run(query)
+            for chat, chat_user in joined:
+                self._members.set((chat, user_id), (chat_user.permissions, chat_user.nickname))
+            return result
         except:
-            print(2)
             traceback.print_exc()
             return False
 
     async def quit(self, chat_id: int, user_id: int) -> bool:
-        try:
-            chat = Chat.get_by_id(chat_id)
+        def query() -> tuple[str, list[int]]:
             user = User.get_by_id(user_id)
-            if chat.sub_chats.exists():
-                for i in (
-                    chat.sub_chats.join(ChatUser)
-                    .where(ChatUser.chat == Chat.id)
-                    .where(ChatUser.user == user)
-                    .execute()
-                ):
-                    # Users must quit any sub chat first, and we help them to quit
-                    i.chat_user.delete_instance()
-            chat_user = ChatUser.get(chat=chat, user=user)
-            chat_user.delete_instance()
-            await self._send_message(chat_id, f"{user.name} has quit the chat.")
-            await self._send_event(
-                chat_id, "quit", {"user_name": user.name, "user_id": user_id}
+            ChatUser.get(chat=chat_id, user=user_id)
+            # Users must quit any sub chat first, and we help them to quit
+            quitted = [chat_id] + [
+                chat
+                for chat, in ChatUser.select(ChatUser.chat)
+                .join(Chat)
+                .where(Chat.parent == chat_id, ChatUser.user == user_id)
+                .tuples()
+            ]
+            ChatUser.delete().where(
+                ChatUser.chat.in_(quitted), ChatUser.user == user_id
+            ).execute()
+            return user.name, quitted
+
+        try:
+            user_name, quitted = await self._db.run(query)
+            for chat in quitted:
+                self._members.pop((chat, user_id))
+            await asyncio.gather(
+                self._send_message(chat_id, f"{user_name} has quit the chat."),
+                self._send_event(
+                    chat_id, "quit", {"user_name": user_name, "user_id": user_id}
+                ),
+                # Sub chats quitted too, other services may have cached them
+                *(
+                    self._send_event(chat, "permission_changed", {"user_id": user_id})
+                    for chat in quitted
+                ),
             )
             return True
         except:
             return False
 
     async def kick(self, chat_id: int, user_id: int, kicked_user_id: int) -> bool:
-        try:
-            chat = Chat.get_by_id(chat_id)
-            user = User.get_by_id(user_id)
+        def query() -> tuple[str, list[int]] | None:
+            if not effective_permissions(chat_id, user_id) & permission_bits["kick"]:
+                return None
             kicked_user = User.get_by_id(kicked_user_id)
-            chat_user = ChatUser.get(chat=chat, user=user)
-            if chat_user.banned:
+            ChatUser.get(chat=chat_id, user=kicked_user_id)
+            # Kick them from any sub-chat too
+            kicked = [chat_id] + [
+                chat
+                for chat, in ChatUser.select(ChatUser.chat)
+                .join(Chat)
+                .where(Chat.parent == chat_id, ChatUser.user == kicked_user_id)
+                .tuples()
+            ]
+            ChatUser.delete().where(
+                ChatUser.chat.in_(kicked), ChatUser.user == kicked_user_id
+            ).execute()
+            return kicked_user.name, kicked
+
+        try:
+            if (result := await self._db.run(query)) is None:
                 return False
-            if not chat_user.kick:
-                parent_chat = chat.parent
-                if parent_chat is None:
-                    return False
-                parent_chat_user = ChatUser.get(chat=parent_chat, user=user)
-                if not parent_chat_user.kick:
-                    return False
-            kicked_chat_user = ChatUser.get(chat=chat, user=kicked_user)
-            if chat.sub_chats.exists():
-                for i in (
-                    chat.sub_chats.join(ChatUser)
-                    .where(ChatUser.chat == Chat.id)
-                    .where(ChatUser.user == kicked_user)
-                    .execute()
-                ):
-                    # Kick him from any sub-chat
-                    i.chat_user.delete_instance()
-            kicked_chat_user.delete_instance()
-            await self._send_message(chat_id, f"{kicked_user.name} has been kicked.")
-            await self._send_event(
-                chat_id,
-                "kick",
-                {
-                    "kicked_user_name": kicked_user.name,
-                    "kicked_user_id": kicked_user_id,
-                },
+            kicked_user_name, kicked = result
+            for chat in kicked:
+                self._members.pop((chat, kicked_user_id))
+            await asyncio.gather(
+                self._send_message(chat_id, f"{kicked_user_name} has been kicked."),
+                self._send_event(
+                    chat_id,
+                    "kick",
+                    {
+                        "kicked_user_name": kicked_user_name,
+                        "kicked_user_id": kicked_user_id,
+                    },
+                ),
+                *(
+                    self._send_event(chat, "permission_changed", {"user_id": kicked_user_id})
+                    for chat in kicked
+                ),
             )
             return True
         except:
             return False
 
     async def rename(self, chat_id: int, user_id: int, new_name: str) -> bool:
-        try:
+        def query() -> str | None:
+            if not effective_permissions(chat_id, user_id) & permission_bits["rename"]:
+                return None
             chat = Chat.get_by_id(chat_id)
-            user = User.get_by_id(user_id)
-            chat_user = ChatUser.get(chat=chat, user=user)
-            if chat_user.banned:
-                return False
-            if not chat_user.rename:
-                parent_chat = chat.parent
-                if parent_chat is None:
-                    return False
-                parent_chat_user = ChatUser.get(chat=parent_chat, user=user)
-                if not parent_chat_user.rename:
-                    return False
             old_name = chat.name
             chat.name = new_name
             chat.save()
-            await self._send_message(chat_id, f"The chat has been renamed {new_name}.")
-            await self._send_event(
-                chat_id, "rename", {"old_name": old_name, "new_name": new_name}
+            return old_name
+
+        try:
+            if (old_name := await self._db.run(query)) is None:
+                return False
+            self._chats.update(chat_id, lambda chat: chat._replace(name=new_name))
+            await asyncio.gather(
+                self._send_message(chat_id, f"The chat has been renamed {new_name}."),
+                self._send_event(
+                    chat_id, "rename", {"old_name": old_name, "new_name": new_name}
+                ),
             )
             return True
         except:
             return False
 
     async def invite(self, chat_id: int, user_id: int, invited_user_id: int) -> bool:
+        def query() -> tuple[str, str, tuple[int, str | None]] | None:
+            # 0 for non-members and banned users, members of a public chat may invite
+            permissions = effective_permissions(chat_id, user_id)
+            if not (permissions & permission_bits["invite"] or chat.public and permissions):
+                return None
+            # Include banned
+            if ChatUser.select().where(
+                ChatUser.chat == chat_id, ChatUser.user == invited_user_id
+            ).exists():
+                return None
+            names = dict(
+                User.select(User.id, User.name)
+                .where(User.id.in_([user_id, invited_user_id]))
+                .tuples()
+            )
+            if invited_user_id not in names:
+                return None
+            invited_chat_user = ChatUser.create(chat=chat_id, user=invited_user_id)
+            return (
+                names[user_id],
+                names[invited_user_id],
+                (invited_chat_user.permissions, invited_chat_user.nickname),
+            )
+
         try:
-            chat = Chat.get_by_id(chat_id)
-            user = User.get_by_id(user_id)
-            invited_user = User.get_by_id(invited_user_id)
-            chat_user = ChatUser.get(chat=chat, user=user)
-            if chat_user.banned:
-                return False
-            if not chat_user.invite and not chat.public:
+            # Chat metadata is cached, what is left is one query for the permissions
+            if (chat := await self._get_chat(chat_id)) is None:
                 return False
-            try:
-                # Include banned
-                ChatUser.get(chat=chat, user=invited_user)
-                return False
-            except:
-                pass
             if chat.parent is not None:
-                parent_chat = chat.parent
-                parent_chat_user = ChatUser.get(chat=chat.parent, user=user)
-                if not parent_chat_user.invite or parent_chat.public:
+                # Nobody is invited to the sub chats of a public chat
+                parent_chat = await self._get_chat(chat.parent)
+                if parent_chat is None or parent_chat.public:
                     return False
-                # Also join parent chat
-                ChatUser.get_or_create(chat=parent_chat, user=user)
-            ChatUser.create(chat=chat, user=invited_user)
-            await self._send_message(
-                chat_id, f"{invited_user.name} has been invited by {user.name}."
-            )
-            await self._send_event(
-                chat_id,
-                "invite",
-                {
-                    "user_name": user.name,
-                    "user_id": user_id,
-                    "invited_user_name": invited_user.name,
-                    "invited_user_id": invited_user_id,
-                },
+            if (result := await self._db.run(query)) is None:
+                return False
+            user_name, invited_user_name, invited_member = result
+            self._members.set((chat_id, invited_user_id), invited_member)
+            await asyncio.gather(
+                self._send_message(
+                    chat_id, f"{invited_user_name} has been invited by {user_name}."
+                ),
+                self._send_event(
+                    chat_id,
+                    "invite",
+                    {
+                        "user_name": user_name,
+                        "user_id": user_id,
+                        "invited_user_name": invited_user_name,
+                        "invited_user_id": invited_user_id,
+                    },
+                ),
             )
             return True
         except:
@@ -267,50 +591,68 @@ class ChatService:
 
     async def check_send(self, chat_id: int, user_id: int) -> bool:
         try:
-            chat_user = ChatUser.get(chat=chat_id, user=user_id)
+            if (member := await self._get_member(chat_id, user_id)) is None:
+                return False
             # Needn't check parent chat user
-            return chat_user.send and not chat_user.banned
+            permissions = member[0]
+            return bool(permissions & permission_bits["send"]) and not (
+                permissions & permission_bits["banned"]
+            )
         except:
             return False
 
     async def check_create_session(self, chat_id: int, user_id: int) -> bool:
         try:
-            chat = Chat.get_by_id(chat_id)
-            if chat.parent is None:
+            chat = await self._get_chat(chat_id)
+            if chat is None or chat.parent is None:
                 return False
-            user = User.get_by_id(user_id)
-            chat_user = ChatUser.get(chat=chat, user=user)
-            return chat_user.create_session and not chat_user.banned
+            if (member := await self._get_member(chat_id, user_id)) is None:
+                return False
+            permissions = member[0]
+            return bool(permissions & permission_bits["create_session"]) and not (
+                permissions & permission_bits["banned"]
+            )
         except:
             return False
 
     async def modify_user_permission(
         self, chat_id: int, user_id: int, modified_user_id: int, name: str, value: bool
     ) -> bool:
-        try:
-            chat = Chat.get_by_id(chat_id)
-            user = User.get_by_id(user_id)
-            chat_user = ChatUser.get(chat=chat, user=user)
-            modified_user = User.get_by_id(modified_user_id)
-            modified_chat_user = ChatUser.get(chat=chat, user=modified_user)
-            if chat_user.banned:
-                return False
-            if not chat_user.modify_permission:
-                parent_chat = chat.parent
-                if parent_chat is None:
-                    return False
-                parent_chat_user = ChatUser.get(chat=parent_chat, user=user)
-                if not parent_chat_user.modify_permission:
-                    return False
+        def query() -> tuple[tuple[int, str | None], list[int]] | None:
             if name not in all_user_permissions:
-                return False
+                return None
+            if not effective_permissions(chat_id, user_id) & permission_bits["modify_permission"]:
+                return None
+            modified_chat_user = ChatUser.get(chat=chat_id, user=modified_user_id)
             # Maybe dangerous
             setattr(modified_chat_user, name, value)
             modified_chat_user.save()
+            member = (modified_chat_user.permissions, modified_chat_user.nickname)
             if name == "banned" and value:
-                ChatUser.update(permissions=ChatUser.banned.set()).where(
-                    ChatUser.chat.parent == chat, ChatUser.user == modified_user
-                ).execute()
+                sub_chats = [
+                    chat for chat, in Chat.select(Chat.id).where(Chat.parent == chat_id).tuples()
+                ]
+                if sub_chats:
+                    ChatUser.update(permissions=ChatUser.banned.set()).where(
+                        ChatUser.chat.in_(sub_chats), ChatUser.user == modified_user_id
+                    ).execute()
+                return member, sub_chats
+            return member, []
+
+        try:
+            if (result := await self._db.run(query)) is None:
+                return False
+            member, sub_chats = result
+            self._members.set((chat_id, modified_user_id), member)
+            for sub_chat in sub_chats:
+                self._members.pop((sub_chat, modified_user_id))
+            # Clients cache what they are allowed to do
+            await asyncio.gather(
+                *(
+                    self._send_event(chat, "permission_changed", {"user_id": modified_user_id})
+                    for chat in [*sub_chats, chat_id]
+                )
+            )
             return True
         except:
             return False
@@ -318,104 +660,124 @@ class ChatService:
     async def modify_permission(
         self, chat_id: int, user_id: int, name: str, value: bool
     ) -> bool:
-        try:
-            chat = Chat.get_by_id(chat_id)
-            user = User.get_by_id(user_id)
-            chat_user = ChatUser.get(chat=chat, user=user)
-            if chat_user.banned:
-                return False
-            if not chat_user.modify_permission:
-                parent_chat = chat.parent
-                if parent_chat is None:
-                    return False
-                parent_chat_user = ChatUser.get(chat=parent_chat, user=user)
-                if not parent_chat_user.modify_permission:
-                    return False
+        def query() -> bool:
             if name not in all_chat_permissions:
                 return False
+            if not effective_permissions(chat_id, user_id) & permission_bits["modify_permission"]:
+                return False
+            chat = Chat.get_by_id(chat_id)
             # Maybe dangerous
             setattr(chat, name, value)
             chat.save()
             return True
+
+        try:
+            if not await self._db.run(query):
+                return False
+            self._chats.update(chat_id, lambda chat: chat._replace(**{name: value}))
+            return True
         except:
             return False
 
     async def get_user_permission(self, chat_id: int, user_id: int) -> dict[str, bool]:
         try:
-            chat_user = ChatUser.get(chat=chat_id, user=user_id)
-            if chat_user.banned:
+            if (member := await self._get_member(chat_id, user_id)) is None:
+                return {}
+            permissions = member[0]
+            if permissions & permission_bits["banned"]:
                 return False
-            return {i: getattr(chat_user, i) for i in all_user_permissions}
+            return {
+                i: bool(permissions & permission_bits[i]) for i in all_user_permissions
+            }
         except:
             return {}
 
     async def get_permission(self, chat_id: int) -> dict[str, bool]:
         try:
-            chat = Chat.get_by_id(chat_id)
+            if (chat := await self._get_chat(chat_id)) is None:
+                return {}
             return {i: getattr(chat, i) for i in all_chat_permissions}
         except:
             return {}
 
     async def get_all_user_permission(self, chat_id: int) -> dict[int, dict[str, bool]]:
-        try:
-            chat_users = ChatUser.select().where(ChatUser.chat == chat_id).execute()
+        def query() -> dict[int, dict[str, bool]]:
+            # user_id is the column itself, reading it doesn't load the user
+            chat_users = ChatUser.select(ChatUser.user, ChatUser.permissions).where(
+                ChatUser.chat == chat_id
+            )
             return {
-                chat_user.user.id: {
+                chat_user.user_id: {
                     name: getattr(chat_user, name) for name in all_user_permissions
                 }
                 for chat_user in chat_users
             }
+
+        try:
+            return await self._db.run(query)
         except:
             return {}
 
     async def list_somebody_joined(self, id: int):
         # after json.dumps, tuple returned will become json Array
-        try:
-            chat_users = (
-                ChatUser.select()
-                .where(~ChatUser.banned, ChatUser.user == id)
+        def query():
+            chats = (
+                ChatUser.select(Chat.id, Chat.name, Chat.parent, Chat.friendship)
                 .join(Chat)
-                .select(Chat.id, Chat.name, Chat.parent, Chat.friendship)
-                .execute()
+                .where(~ChatUser.banned, ChatUser.user == id)
+                .tuples()
             )
             return [
                 {
-                    "id": chat_user.chat.id,
-                    "name": chat_user.chat.name,
-                    "parent": None if chat_user.chat.parent is None else chat_user.chat.parent.id,
-                    "is_friend": chat_user.chat.friendship is not None
+                    "id": chat_id,
+                    "name": name,
+                    "parent": parent,
+                    "is_friend": friendship is not None,
                 }
-                for chat_user in chat_users
+                for chat_id, name, parent, friendship in chats
             ]
+
+        try:
+            return await self._db.run(query)
         except:
             return []
 
     async def list_sub_chats(self, id: int) -> list[tuple[int, str]]:
-        return [
-            (i.id, i.name) for i in Chat.select().where(Chat.parent == id).execute()
-        ]
+        return await self._db.run(
+            lambda: [
+                (i.id, i.name) for i in Chat.select().where(Chat.parent == id).execute()
+            ]
+        )
 
     async def change_nickname(
         self, chat_id: int, user_id: int, changed_user_id: int, new_name: str
     ):
-        if changed_user_id == user_id or (
-            (chat_user := ChatUser.get_or_none(chat=chat_id, user=user_id)) is not None
-            and chat_user.change_nickname
-            and not chat_user.banned
-        ):
-            ChatUser.update(nickname=new_name).where(
-                ChatUser.chat == chat_id, ChatUser.user == changed_user_id
-            ).execute()
-            return True
-        return False
+        if changed_user_id != user_id:
+            member = await self._get_member(chat_id, user_id)
+            if (
+                member is None
+                or not member[0] & permission_bits["change_nickname"]
+                or member[0] & permission_bits["banned"]
+            ):
+                return False
+        await self._db.run(
+            lambda: ChatUser.update(nickname=new_name)
+            .where(ChatUser.chat == chat_id, ChatUser.user == changed_user_id)
+            .execute()
+        )
+        self._members.update(
+            (chat_id, changed_user_id), lambda member: (member[0], new_name)
+        )
+        return True
 
     async def get_nickname(self, chat_id: int, user_id: int):
         if user_id == SYSTEM_UID:
             return SYSTEM_USER_NAME
-        chat_user = ChatUser.get_or_none(chat=chat_id, user=user_id)
-        if chat_user is not None and chat_user.nickname is not None:
-            return chat_user.nickname
-        user = User.get_or_none(user=user_id)
+
+        member = await self._get_member(chat_id, user_id)
+        if member is not None and member[1] is not None:
+            return member[1]
+        user = await self._db.run(User.get_or_none, id=user_id)
         if user is None:
             return None
         if user.nickname is None:
@@ -425,6 +787,10 @@ class ChatService:
 
 if __name__ == "__main__":
     db.create_tables([User, Chat, ChatUser, FriendRequest, Friendship])
+    asyncio.set_event_loop(loop := asyncio.new_event_loop())
     server = base.RpcServiceFactory()
-    server.register(ChatService(),async_mode=True,name="chat")
-    server.connect()
+    server.register(service := ChatService(), async_mode=True, name="chat")
+    server.pools.setdefault("chat", {})["database"] = service._db
+    loop.create_task(server.aconnect())
+    loop.create_task(service._ainit())
+    loop.run_forever()
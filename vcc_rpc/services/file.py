@@ -103,5 +103,5 @@ class File:
 
 if __name__ == "__main__":
     server = base.RpcServiceFactory()
-    server.register(File())
+    server.register(File(), threads=8)
     server.connect()
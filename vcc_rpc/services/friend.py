@@ -87,5 +87,5 @@ class FriendService:
 if __name__ == "__main__":
     db.create_tables([User, Chat, ChatUser, Friendship, FriendRequest])
     server = RpcServiceFactory()
-    server.register(FriendService(), name="friend")
+    server.register(FriendService(), name="friend", threads=4)
     server.connect()
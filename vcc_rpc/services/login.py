@@ -50,7 +50,7 @@ class Login:
             return None
         if not user.login:
             return None
-        hashed_password = to_hashed(user.salt, password)
+        hashed_password = base.run_in_process(to_hashed, user.salt, password)
         if hashed_password != user.password:
             return None
         return user.id, jwt.encode({
@@ -70,7 +70,7 @@ class Login:
     def register(self, username, password, oauth=None, oauth_data=None,nickname:str|None=None,login: bool = True):
         if username == "system":
             return False
-        hashed_password = to_hashed(salt := random_string(10), password)
+        hashed_password = base.run_in_process(to_hashed, salt := random_string(10), password)
         try:
             User(
                 name=username,
@@ -127,6 +127,20 @@ class Login:
             metadata.value = str(value(metadata.value))
         metadata.save()
 
+    def _add_online_count(self, uid: int, delta: int):
+        # Login runs on several threads, so let the database do the increment
+        # instead of a read-modify-write that loses updates
+        count = UserMetadata.value.cast("integer") + delta
+        with db.atomic():
+            UserMetadata.insert(
+                id=uid, key="online_count", value=str(max(delta, 0))
+            ).on_conflict(
+                conflict_target=[UserMetadata.id],
+                update={
+                    UserMetadata.value: Case(None, [(count > 0, count)], 0).cast("varchar")
+                },
+            ).execute()
+
     def get_name(self, id: int) -> str | None:
         user = User.get_or_none(id=id)
         if user is None:
@@ -148,18 +162,14 @@ class Login:
         user = User.get_or_none(id=id)  # A stupid query just for check if user exists
         if user is None:
             return False
-        self.modify_metadata(id, "online_count", lambda x: int(x) + 1 if x != "" else 1)
+        self._add_online_count(id, 1)
         return True
 
     def add_offline(self, id: int) -> bool:
         user = User.get_or_none(id=id)
         if user is None:
             return False
-        self.modify_metadata(
-            id,
-            "online_count",
-            lambda x: (1 if int(x) < 0 else int(x)) - 1 if x != "" else 0,
-        )
+        self._add_online_count(id, -1)
         return True
     def is_online(self, ids: Any) -> list[bool]:
         try:
@@ -177,10 +187,10 @@ class Login:
         user = User.get_or_none(id=id)
         if user is None:
             return False
-        hashed_old_password = to_hashed(user.salt, old_password)
+        hashed_old_password = base.run_in_process(to_hashed, user.salt, old_password)
         if user.password != hashed_old_password:
             return False
-        user.password = to_hashed(user.salt, old_password)
+        user.password = base.run_in_process(to_hashed, user.salt, old_password)
         user.login = True
         user.save()
         return True
@@ -189,5 +199,6 @@ class Login:
 if __name__ == "__main__":
     db.create_tables([User, UserMetadata])
     server = base.RpcServiceFactory()
-    server.register(Login())
+    # Blocking queries in threads, hashing in processes
+    server.register(Login(), threads=8, processes=2)
     server.connect()
@@ -1,5 +1,8 @@
+import asyncio
+import concurrent.futures
 import datetime
 import itertools
+import time
 import typing
 from peewee import (
     Model,
@@ -15,6 +18,8 @@ from peewee import (
 )
 from peewee import *
 from playhouse.shortcuts import ReconnectMixin
+from vcc.metrics import Histogram
+from vcc.service import ServicePool
 import os
 
 
@@ -111,6 +116,42 @@ class ChatUser(Model):
     class Meta:
         indexes = ((("user", "chat"), True),)
 
+def permission_bit(name: str) -> int:
+    """Bit of a ChatUser permission in ChatUser.permissions"""
+    chat_user = ChatUser(permissions=0)
+    setattr(chat_user, name, True)
+    return chat_user.permissions
+
+
+def effective_permissions(chat_id: int, user_id: int) -> int:
+    """
+    Permissions of a user in a chat together with the ones granted in the parent
+    chat, 0 for banned users and non-members. One query.
+    """
+    ParentChatUser = ChatUser.alias()
+    row = (
+        ChatUser.select(ChatUser.permissions, ParentChatUser.permissions)
+        .join(Chat)
+        .join(
+            ParentChatUser,
+            JOIN.LEFT_OUTER,
+            on=(ParentChatUser.chat == Chat.parent) & (ParentChatUser.user == ChatUser.user),
+        )
+        .where(ChatUser.chat == chat_id, ChatUser.user == user_id)
+        .tuples()
+        .first()
+    )
+    if row is None:
+        return 0
+    permissions, parent_permissions = row
+    banned = permission_bit("banned")
+    if permissions & banned:
+        return 0
+    if parent_permissions is not None and not parent_permissions & banned:
+        permissions |= parent_permissions
+    return permissions
+
+
 class Bot(Model):
     id = BigAutoField(primary_key=True)
     name = CharField(max_length=16, unique=True)
@@ -169,3 +210,44 @@ def get_database():
                 "ignore_check_constraints": 0,
             },
         )
+
+
+class DatabaseExecutor(ServicePool):
+    """
+    Runs blocking queries in a bounded pool of threads so that they don't stall
+    the event loop. Peewee keeps connections per thread, so every worker has its own.
+    Put it in RpcServiceFactory.pools to get the numbers in get_stats.
+    """
+
+    def __init__(self, database: Database, size: int | None = None):
+        size = int(os.getenv("DATABASE_THREADS", 8)) if size is None else size
+        super().__init__(
+            concurrent.futures.ThreadPoolExecutor(size, thread_name_prefix="database"), size
+        )
+        self.database = database
+        # Time spent waiting for a free worker, and running the query
+        self.wait = Histogram()
+        self.query = Histogram()
+
+    def _run(self, submitted: float, func, args, kwargs):
+        start = time.perf_counter()
+        try:
+            return func(*args, **kwargs)
+        finally:
+            with self._lock:
+                self.wait.observe(start - submitted)
+                self.query.observe(time.perf_counter() - start)
+
+    async def run(self, func, *args, **kwargs):
+        """Await func(*args, **kwargs) run in a worker"""
+        return await asyncio.wrap_future(
+            self.submit(self._run, time.perf_counter(), func, args, kwargs)
+        )
+
+    def snapshot(self) -> dict[str, typing.Any]:
+        return super().snapshot() | {
+            "wait_p50": self.wait.quantile(0.5),
+            "wait_p99": self.wait.quantile(0.99),
+            "query_p50": self.query.quantile(0.5),
+            "query_p99": self.query.quantile(0.99),
+        }
@@ -1,10 +1,11 @@
 import functools
 import asyncio
 import os
+import socket
 import time
 from typing import cast
 
-from vcc.tools import RedisMessage
+from vcc.tools import RedisMessage, bus, chat_channels, decode_bus, get_streams
 
 import base
 from base import ServiceExport as export
@@ -13,7 +14,6 @@ import redis.asyncio as redis
 import aiohttp
 import models
 import peewee
-import json
 from models import *
 
 db = get_database()
@@ -22,6 +22,13 @@ bind_model(User, db)
 bind_model(Chat, db)
 bind_model(Message, db)
 
+# Messages sent in one chunk of query_record
+PAGE_SIZE = int(os.getenv("RECORD_PAGE_SIZE", 100))
+# Consumer group of the record services with VCC_BUS=streams, the consumer name has
+# to stay the same across restarts to get back what wasn't acknowledged
+RECORD_GROUP = "record"
+RECORD_CONSUMER = os.getenv("RECORD_CONSUMER", socket.gethostname())
+
 
 def timer(interval, func=None):
     if func == None:
@@ -38,60 +45,125 @@ def timer(interval, func=None):
 
 
 class Record(metaclass=base.ServiceMeta):
-    async def record_worker(self):
-        async for raw_message in self._pubsub.listen():
-            if raw_message["type"] == "message":
-                self._messages.append(json.loads(raw_message["data"].decode()))
+    async def record_worker(self, pubsub):
+        async for raw_message in pubsub.listen():
+            if raw_message["type"] in ("message", "pmessage"):
+                self._messages.append(decode_bus(raw_message["data"]))
+
+    async def stream_worker(self, shard: int):
+        redis_shard = self._shards[shard]
+        keys = get_streams("messages")
+        for key in keys:
+            try:
+                await redis_shard.xgroup_create(key, RECORD_GROUP, id="0", mkstream=True)
+            except redis.ResponseError:
+                # BUSYGROUP, another record service created it
+                pass
+        # What was read before a restart and never acknowledged comes first
+        ids = {key: "0" for key in keys}
+        while True:
+            try:
+                result = await redis_shard.xreadgroup(
+                    RECORD_GROUP, RECORD_CONSUMER, ids, count=100, block=1000
+                )
+            except (redis.TimeoutError, redis.ConnectionError):
+                await asyncio.sleep(1)
+                continue
+            for key, entries in result or []:
+                key = key.decode()
+                if ids[key] != ">":
+                    ids[key] = entries[-1][0] if entries else ">"
+                for id, fields in entries:
+                    self._messages.append(decode_bus(fields[b"data"]))
+                    self._unacked.append((shard, key, id))
 
     @timer(5)
     async def flush_worker(self):
-        messages = self._messages.copy()
-        self._messages.clear()
-        with db.atomic():
-            await asyncio.get_running_loop().run_in_executor(
-                None,
-                lambda: Message.insert_many(
-                    [
-                        {
-                            "user": msg["uid"],
-                            "chat": msg["chat"],
-                            "content": msg["payload"],
-                            "time": msg["time"],
-                            "type": msg["msg_type"],
-                            "id": msg["id"],
-                        }
-                        for msg in messages
-                        if "session" not in msg
-                    ]
-                ).execute(),
+        messages, self._messages = self._messages, []
+        unacked, self._unacked = self._unacked, []
+        rows = []
+        for msg in messages:
+            if "session" in msg:
+                continue
+            try:
+                rows.append({
+                    "user": msg["uid"],
+                    "chat": msg["chat"],
+                    "content": msg["payload"],
+                    "time": msg["time"],
+                    "type": msg["msg_type"],
+                    "id": msg["id"],
+                })
+            except KeyError:
+                # Retrying it wouldn't help
+                vcc.log.warning(f"malformed message {msg}")
+
+        def insert():
+            with db.atomic():
+                # Ignore conflicts, streams deliver at least once
+                Message.insert_many(rows).on_conflict_ignore().execute()
+
+        try:
+            if rows:
+                await self._db.run(insert)
+        except Exception:
+            # Retry them with the next flush
+            self._messages[:0] = messages
+            self._unacked[:0] = unacked
+            raise
+        for shard, key in {(shard, key) for shard, key, _ in unacked}:
+            await self._shards[shard].xack(
+                key, RECORD_GROUP, *[id for i, j, id in unacked if (i, j) == (shard, key)]
             )
 
     async def _ainit(self):
         await self._vcc.__aenter__()
-        await self._pubsub.subscribe("messages")
-        asyncio.get_event_loop().create_task(self.record_worker())
+        # Every shard holds the messages of some chats
+        for shard, pubsub in enumerate(self._pubsubs):
+            if bus == "streams":
+                asyncio.get_event_loop().create_task(self.stream_worker(shard))
+                continue
+            if chat_channels:
+                await pubsub.psubscribe("messages:*")
+            else:
+                await pubsub.subscribe("messages")
+            asyncio.get_event_loop().create_task(self.record_worker(pubsub))
         return await self.flush_worker()
 
+    def _query_page(self, chatid: int, time: int, last: tuple[int, str] | None):
+        # Keyset pagination on (time, id), so a page never rescans the ones before it
+        query = Message.select().where((Message.chat == chatid) & (Message.time >= time))
+        if last is not None:
+            query = query.where(
+                (Message.time > last[0]) | ((Message.time == last[0]) & (Message.id > last[1]))
+            )
+        return [
+            {**i, "id": str(i["id"])}
+            for i in query.order_by(Message.time, Message.id).limit(PAGE_SIZE).dicts()
+        ]
+
     @export(async_mode=True)
     async def query_record(self, chatid: int, time: int):
+        """Stream the messages of a chat since time, PAGE_SIZE at a time"""
         if time > int(globals()["time"].time() * 1000):
-            return []
-
-        return await asyncio.get_running_loop().run_in_executor(
-            None,
-            lambda: [
-                {**i, "id": str(i["id"])}
-                for i in Message.select()
-                .where((Message.chat == chatid) & (Message.time >= time))
-                .dicts()
-            ],
-        )
+            return
+        last = None
+        while True:
+            page = await self._db.run(self._query_page, chatid, time, last)
+            if page:
+                yield page
+            if len(page) < PAGE_SIZE:
+                return
+            last = (page[-1]["time"], page[-1]["id"])
 
     def __init__(self):
         self._vcc = vcc.RpcExchanger()
-        self._redis = self._vcc.get_redis_instance()
-        self._pubsub = self._redis.pubsub()
+        self._shards = self._vcc.get_redis_instances()
+        self._pubsubs = [i.pubsub() for i in self._shards]
+        self._db = DatabaseExecutor(db)
         self._messages: list[RedisMessage] = list()
+        # (shard, stream, id) of the messages read from streams but not saved yet
+        self._unacked: list[tuple[int, str, bytes]] = list()
         # asyncio.get_event_loop().create_task(self._ainit())
 
 
@@ -101,6 +173,7 @@ if __name__ == "__main__":
     server = base.RpcServiceFactory()
     service = Record()
     server.register(service)
+    server.pools.setdefault("record", {})["database"] = service._db
     loop.create_task(server.aconnect())
     loop.create_task(service._ainit())
     loop.run_forever()
@@ -0,0 +1,13 @@
+import os
+import sys
+import tempfile
+from pathlib import Path
+
+# The services import each other as top-level modules and read DATABASE on import,
+# base.py needs vcc from vcc_lib
+sys.path.insert(0, str(Path(__file__).parent.parent.parent / "vcc_lib"))
+sys.path.insert(0, str(Path(__file__).parent.parent / "services"))
+os.environ.setdefault(
+    "DATABASE",
+    f"SqliteDatabase({str(Path(tempfile.mkdtemp()) / 'test.db')!r})",
+)
@@ -0,0 +1,45 @@
+import asyncio
+
+import base
+import chat
+from vcc.tools import decode_bus
+
+
+def call(factory, namespace: str, service: str, **data):
+    """Run a call through the transport like a request from the router, the frames sent are returned"""
+    frames = []
+    transport = factory.transports["tcp"](factory)
+    request = {"service": service, "namespace": namespace, "data": data, "jobid": "1"}
+    asyncio.run(transport.do_request(request, send=lambda **frame: frames.append(frame)))
+    return frames
+
+
+def test_cache_stats_over_rpc():
+    factory = base.RpcServiceFactory()
+    factory.register(chat.ChatService(), async_mode=True, name="chat")
+    [frame] = call(factory, "chat", "get_cache_stats")
+    assert frame["type"] == "respond"
+    assert set(frame["data"]) == {"members", "chats"}
+    assert frame["data"]["members"] == {"size": 0, "hits": 0, "misses": 0}
+
+
+def test_own_events_keep_the_cache():
+    service = chat.ChatService()
+    published = []
+
+    class Publisher:
+        def publish(self, kind, chat_id, data):
+            published.append(decode_bus(data))
+            future = asyncio.get_running_loop().create_future()
+            future.set_result(None)
+            return future
+
+    service._publisher = Publisher()
+    asyncio.run(service._send_event(1, "permission_changed", {"user_id": 2}))
+    service._members.set((1, 2), (16, None))
+    # Written through by the method which published it
+    service._forget_changed(published[0])
+    assert service._members.get((1, 2)) == (16, None)
+    # From bot.py or another chat service
+    service._forget_changed({"type": "permission_changed", "data": {"user_id": 2}, "chat": 1})
+    assert service._members.get((1, 2)) is chat._missing
@@ -0,0 +1,76 @@
+import asyncio
+
+import pytest
+
+import chat
+from models import Chat, ChatUser, Friendship, User
+
+
+@pytest.fixture
+def queries(monkeypatch):
+    """SQL statements run by the chat service"""
+    db = ChatUser._meta.database
+    db.create_tables([User, Friendship, Chat, ChatUser])
+    executed = []
+    execute_sql = db.execute_sql
+
+    def count(sql, *args, **kwargs):
+        executed.append(sql)
+        return execute_sql(sql, *args, **kwargs)
+
+    monkeypatch.setattr(db, "execute_sql", count)
+    yield executed
+    monkeypatch.undo()
+    db.drop_tables([User, Friendship, Chat, ChatUser])
+
+
+def make_users(count: int) -> list[int]:
+    first = User.select(User.id).order_by(User.id.desc()).scalar() or 0
+    User.insert_many(
+        [
+            dict(name=f"u{first + i}", nickname=f"U{i}", password="", salt="")
+            for i in range(count)
+        ]
+    ).execute()
+    return [user for user, in User.select(User.id).where(User.id > first).tuples()]
+
+
+def make_chat(members: int) -> int:
+    """A chat with `members` users, the chat is returned"""
+    chat_id = Chat.insert(name=f"chat{members}", parent=None).execute()
+    ChatUser.insert_many(
+        [
+            dict(chat=chat_id, user=user, permissions=0, nickname=None)
+            for user in make_users(members)
+        ]
+    ).execute()
+    return chat_id
+
+
+def make_member(chats: int) -> int:
+    """A user in `chats` chats, the user is returned"""
+    user = make_users(1)[0]
+    for i in range(chats):
+        chat_id = Chat.insert(name=f"chat{i}", parent=None).execute()
+        ChatUser.insert(chat=chat_id, user=user, permissions=0, nickname=None).execute()
+    return user
+
+
+@pytest.mark.parametrize(
+    "method, make",
+    [
+        ("get_users", make_chat),
+        ("get_all_user_permission", make_chat),
+        ("list_somebody_joined", make_member),
+    ],
+)
+def test_listing_is_one_query(queries, method, make):
+    service = chat.ChatService()
+    counts = []
+    for size in (10, 200):
+        id = make(size)
+        queries.clear()
+        result = asyncio.run(getattr(service, method)(id))
+        assert len(result) == size
+        counts.append(len(queries))
+    assert counts == [1, 1]
@@ -3,7 +3,6 @@ from typing import Any, NamedTuple, cast
 
 import os
 import asyncio
-import json
 import logging
 import jwt
 import sys
@@ -11,7 +10,7 @@ from uuid import uuid4
 from datetime import datetime, timedelta, timezone
 from pathlib import Path
 
-from vcc import RpcExchanger, RpcExchangerClient, PermissionDeniedError
+from vcc import RpcExchanger, RpcExchangerClient, PermissionDeniedError, json_codec
 from sanic import Sanic, Request, Websocket, html
 from sanic.response import text, file_stream
 from sanic.exceptions import NotFound
@@ -53,14 +52,7 @@ async def recv_loop(websocket: Websocket, client: RpcExchangerClient) -> None:
                 # await websocket.send(json_msg)
                 continue
             _, message= result
-            json_msg = json.dumps(
-                {
-                    "method": "message",
-                    "params": message,
-                    "jsonrpc": "2.0",
-                }
-            )
-            await websocket.send(json_msg)
+            await websocket.send(message.jsonrpc)
     except Exception as e:
         logging.info(e, exc_info=True)
         await websocket.close(1008)
@@ -81,7 +73,7 @@ async def rpc_awaiter(response, websocket: Websocket):
             logging.warn("Uncaught exception", exc_info=e)
             await websocket.close(1008)
 
-    await websocket.send(json.dumps(data))
+    await websocket.send(json_codec.dumps(data).decode())
 
 
 async def send_loop(
@@ -133,12 +133,19 @@ class Methods:
         return await self._client.session_join(name, parent)
 
     async def chat_create(self, name: str, parent: int | None) -> int:
-        return await self._client.chat_create(
+        chat = await self._client.chat_create(
             name, -1 if parent == 0 or parent is None else parent
         )
+        # Joining publishes no event, see webpush.register_recv_hook for the others
+        if chat is not None and self._client.id is not None:
+            push_chats_changed(self._client._exchanger, self._client.id, joined=(chat,))
+        return chat
 
     async def chat_join(self, chat: int) -> bool:
-        return await self._client.chat_join(chat)
+        joined = await self._client.chat_join(chat)
+        if joined and self._client.id is not None:
+            push_chats_changed(self._client._exchanger, self._client.id, joined=(chat,))
+        return joined
 
     async def chat_quit(self, chat: int) -> bool:
         return await self._client.chat_quit(chat)
@@ -146,6 +153,9 @@ class Methods:
     async def chat_get_name(self, chat: int) -> str:
         return await self._client.chat_get_name(chat)
 
+    async def chat_get_names(self, chats: list[int]) -> list[str | None]:
+        return await self._client.chat_get_names(chats)
+
     async def chat_list(self) -> list[ChatInfo]:
         return await self._client.chat_list()
 
@@ -243,6 +253,9 @@ class Methods:
     async def chat_get_nickname(self, chat: int, user: int) -> str:
         return await self._client.chat_get_nickname(chat, user)
 
+    async def chat_get_nicknames(self, chat: int, users: list[int]) -> list[str | None]:
+        return await self._client.chat_get_nicknames(chat, users)
+
     async def chat_change_nickname(self, chat: int, user: int, name: str) -> bool:
         return await self._client.chat_change_nickname(chat, user, name)
 
@@ -252,7 +265,14 @@ class Methods:
     async def push_register(self, subscription: Any) -> None:
         if self._client.id is None:
             raise CloseException(1008)
-        push_register(self._client.id, subscription)
+        push_register(
+            self._client.id, subscription, self._client._exchanger, self._client._chat_list
+        )
+
+    async def push_unregister(self) -> None:
+        if self._client.id is None:
+            raise CloseException(1008)
+        push_unregister(self._client.id, self._client._exchanger)
 
     async def friend_get_friends(self) -> list[int]:
         return await self._client.get_friends()
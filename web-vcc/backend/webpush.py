@@ -26,20 +26,44 @@ application_server_key = b64urlencode(
 )
 
 _push_list = {}
+# Chats subscribed on behalf of the users in _push_list
+_push_chats: dict[int, set[int]] = {}
 
 
-def push_register(id: int, msg):
+def push_chats_changed(exchanger: vcc.RpcExchanger, id: int, joined=(), quitted=()):
+    """Follow the chats of a user registered for pushes"""
+    # Pushes are for offline users too, so keep the chats subscribed after they leave
+    if (subscribed := _push_chats.get(id)) is None:
+        return
+    for chat in set(joined) - subscribed:
+        subscribed.add(chat)
+        exchanger.acquire_chat(chat)
+    for chat in set(quitted) & subscribed:
+        subscribed.discard(chat)
+        exchanger.release_chat(chat)
+
+
+def push_register(id: int, msg, exchanger: vcc.RpcExchanger | None = None, chats=()):
     _push_list[id] = msg
+    if exchanger is not None:
+        subscribed = _push_chats.setdefault(id, set())
+        push_chats_changed(exchanger, id, joined=chats, quitted=subscribed - set(chats))
+
+
+def push_unregister(id: int, exchanger: vcc.RpcExchanger | None = None):
+    _push_list.pop(id, None)
+    if exchanger is not None and id in _push_chats:
+        push_chats_changed(exchanger, id, quitted=set(_push_chats[id]))
+        del _push_chats[id]
 
 
 def register_recv_hook(exchanger: vcc.RpcExchanger):
-    async def handler(msg: vcc.RedisMessage):
-        user_list: list[tuple[int, str]] = await exchanger.rpc_request(
-            "chat", "get_users", {"id": msg["chat"]}
-        )
-        chat_name: str = await exchanger.rpc_request(
-            "chat", "get_name", {"id": msg["chat"]}
-        )
+    # Messages waiting to be pushed, the users and names of their chats are fetched
+    # together in one get_users_many and one get_names every push_delay seconds
+    pending: list[vcc.RedisMessage] = []
+    push_delay = float(os.getenv("WEBPUSH_DELAY", 0.05))
+
+    def push(msg: vcc.RedisMessage, user_list: list[tuple[int, str]], chat_name: str):
         send_nickname = None
         for id, nickname in user_list:
             if id == msg["uid"]:
@@ -49,7 +73,7 @@ def register_recv_hook(exchanger: vcc.RpcExchanger):
         for id, nickname in user_list:
             if id not in _push_list:
                 continue
-            push_func = lambda: pywebpush.webpush(
+            push_func = lambda id=id: pywebpush.webpush(
                 _push_list[id],
                 json.dumps(
                     {
@@ -66,6 +90,42 @@ def register_recv_hook(exchanger: vcc.RpcExchanger):
             task_list.append(
                 asyncio.get_running_loop().run_in_executor(None, push_func)
             )
+        return task_list
+
+    async def push_pending():
+        messages = pending[:]
+        pending.clear()
+        chats = list(dict.fromkeys(msg["chat"] for msg in messages))
+        # Sent together, in one batch frame with VCC_RPC_BATCH
+        users_many, names = await asyncio.gather(
+            exchanger.rpc_request("chat", "get_users_many", {"chat_ids": chats}),
+            exchanger.rpc_request("chat", "get_names", {"ids": chats}),
+        )
+        users = dict(zip(chats, users_many))
+        chat_names = dict(zip(chats, names))
+        task_list = []
+        for msg in messages:
+            task_list += push(msg, users[msg["chat"]], chat_names[msg["chat"]])
         await asyncio.gather(*task_list)
 
+    def handler(msg: vcc.RedisMessage):
+        pending.append(msg)
+        if len(pending) == 1:
+            asyncio.get_running_loop().call_later(
+                push_delay, lambda: asyncio.create_task(push_pending())
+            )
+
+    def event_handler(type: str, data, chat: int):
+        # Like RpcExchangerClient.recv, for the users who may be offline
+        match type:
+            case "join":
+                push_chats_changed(exchanger, data["user_id"], joined=(chat,))
+            case "invite":
+                push_chats_changed(exchanger, data["invited_user_id"], joined=(chat,))
+            case "quit":
+                push_chats_changed(exchanger, data["user_id"], quitted=(chat,))
+            case "kick":
+                push_chats_changed(exchanger, data["kicked_user_id"], quitted=(chat,))
+
     exchanger.recv_hook = handler
+    exchanger.event_hook = event_handler
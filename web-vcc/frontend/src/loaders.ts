@@ -371,6 +371,8 @@ export function chooseBackendLoader({ request: { url } }: LoaderFunctionArgs) {
 }
 
 export function logoutLoader() {
+  // Stop the pushes of this user, don't wait for it
+  rpc.push.unregister().catch(() => {})
   clearData()
   queryClient.clear()
   location.pathname = "/login"
@@ -86,6 +86,24 @@ async function makeRequest<K extends keyof MethodType>(method: K, request: Param
   return (await useStore.getState().makeRequest(method, request as any)) as unknown as ReturnType<MethodType[K]>
 }
 
+type NicknameRequest = { resolve: (nickname: string | null) => void; reject: (reason: any) => void }
+
+// Nicknames asked for in the same tick, by chat then user, are fetched with one request per chat
+const pendingNicknames = new Map<number, Map<number, NicknameRequest[]>>()
+
+function flushNicknames() {
+  const pending = [...pendingNicknames]
+  pendingNicknames.clear()
+  for (const [chat, requests] of pending) {
+    const users = [...requests.keys()]
+    makeRequest("chat_get_nicknames", { chat, users }).then(
+      (nicknames: (string | null)[]) =>
+        users.forEach((user, index) => requests.get(user)!.forEach(({ resolve }) => resolve(nicknames[index]))),
+      reason => requests.forEach(waiting => waiting.forEach(({ reject }) => reject(reason)))
+    )
+  }
+}
+
 const rpc = {
   chat: {
     async quit(chat: number): Promise<boolean> {
@@ -177,10 +195,12 @@ const rpc = {
       const data = await makeRequest("chat_list", {})
       return responseToChatList(data)
     },
-    async getNickname(chat: number, user: number) {
-      return await makeRequest("chat_get_nickname", {
-        user,
-        chat
+    getNickname(chat: number, user: number): Promise<string | null> {
+      return new Promise((resolve, reject) => {
+        if (pendingNicknames.size == 0) setTimeout(flushNicknames)
+        const requests = pendingNicknames.get(chat) ?? new Map<number, NicknameRequest[]>()
+        pendingNicknames.set(chat, requests)
+        requests.set(user, [...(requests.get(user) ?? []), { resolve, reject }])
       })
     }
   },
@@ -277,6 +297,9 @@ const rpc = {
       await makeRequest("push_register", {
         subscription
       })
+    },
+    async unregister() {
+      await makeRequest("push_unregister", {})
     }
   },
   friend: {